@@ -0,0 +1,273 @@
+# Benchmark suite for htmlshare: POST /html, GET /html/{id} and DELETE /html/{id} at increasing concurrency, with
+# posts built from misc/post_template.html the same way the bot builds them. Writes JSON report, so results of
+# different commits can be compared with any diff tool.
+# Run from repo root:
+#   python benchmarks/htmlshare_suite.py --json htmlshare.json                 # app called in-process through ASGI
+#   python benchmarks/htmlshare_suite.py --server uvicorn --json htmlshare.json  # real server in subprocess
+#   python benchmarks/htmlshare_suite.py --clients 64 --uploads 2000 --size 8000 --phases upload  # uploads only
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Optional
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PASSWORD = 'benchmark'
+PHASES = ('upload', 'read', 'delete')
+WORDS = ('telegram raindrop bookmark article reading mode saved forwarded channel post link photo message '
+         'longread summary source update release notes thread discussion').split()
+
+
+def load_template() -> str:
+    with open(os.path.join(ROOT, 'misc', 'post_template.html')) as f:
+        return f.read()
+
+
+def paragraph(rnd: random.Random) -> str:
+    words = [rnd.choice(WORDS) for _ in range(rnd.randint(20, 120))]
+    if rnd.random() < 0.3:
+        words.insert(rnd.randrange(len(words)),
+                     f'<a href="https://example.com/{rnd.randrange(10 ** 6)}" rel="nofollow" target="_blank">link</a>')
+    return '<p>' + ' '.join(words) + '</p>'
+
+
+def generate_post(template: str, rnd: random.Random) -> str:
+    # Mostly single posts, sometimes stacks of forwarded messages with pictures, rarely huge ones
+    kind = rnd.random()
+    messages = 1 if kind < 0.7 else rnd.randint(2, 10) if kind < 0.97 else rnd.randint(30, 80)
+    html = ''
+    for _ in range(messages):
+        if messages > 1:
+            html += '<p class="forward-from">Forwarded from: <span class="forward-source">Channel</span></p>'
+        if rnd.random() < 0.2:
+            html += f'<img src="https://telegra.ph/file/{rnd.randrange(10 ** 9):x}.jpg">'
+        html += ''.join(paragraph(rnd) for _ in range(rnd.randint(1, 6)))
+    return template.replace('{{text}}', html)
+
+
+def fixed_size_post(size: int) -> str:
+    return '<p>' + 'Lorem ipsum dolor sit amet. ' * (size // 28) + '</p>'
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def storage_size(data_dir: str) -> int:
+    total = 0
+    for directory, _, files in os.walk(data_dir):
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+    return total
+
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def report(self) -> dict:
+        done = len(self.latencies)
+        return {
+            'requests': done,
+            'errors': self.errors,
+            'rps': round(done / self.elapsed, 1) if self.elapsed else 0.0,
+            'p50_ms': round(percentile(self.latencies, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(self.latencies, 0.99) * 1000, 2),
+            'mb_per_s': round(self.bytes / self.elapsed / 1024 / 1024, 2) if self.elapsed else 0.0,
+        }
+
+
+async def run_phase(phase: Phase, clients: int, jobs: list, request):
+    queue = list(reversed(jobs))
+
+    async def worker():
+        while queue:
+            job = queue.pop()
+            started = time.perf_counter()
+            try:
+                size = await request(job)
+            except Exception:
+                phase.errors += 1
+                continue
+            phase.latencies.append(time.perf_counter() - started)
+            phase.bytes += size
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(clients)])
+    phase.elapsed = time.perf_counter() - started
+
+
+async def run_level(client: httpx.AsyncClient, clients: int, posts: List[str], reads: int, data_dir: str,
+                    phase_names: List[str]) -> dict:
+    ids = []
+
+    async def upload(html: str) -> int:
+        response = await client.post('/html', json={'html': html, 'password': PASSWORD})
+        response.raise_for_status()
+        ids.append(response.json()['id'])
+        return len(html)
+
+    async def read(doc_id: str) -> int:
+        response = await client.get(f'/html/{doc_id}')
+        response.raise_for_status()
+        return len(response.content)
+
+    async def delete(doc_id: str) -> int:
+        response = await client.delete(f'/html/{doc_id}', params={'password': PASSWORD})
+        response.raise_for_status()
+        return 0
+
+    size_before = storage_size(data_dir)
+    phases = {name: Phase(name) for name in phase_names}
+    # Reads and deletes need uploaded documents, so upload is always run
+    await run_phase(phases.get('upload', Phase('upload')), clients, posts, upload)
+    size_after_upload = storage_size(data_dir)
+
+    rnd = random.Random(clients)
+    if 'read' in phases:
+        await run_phase(phases['read'], clients, [rnd.choice(ids) for _ in range(reads)] if ids else [], read)
+    if 'delete' in phases:
+        # Half of documents is deleted, the rest stays, so storage keeps growing between levels like in real life
+        await run_phase(phases['delete'], clients, ids[::2], delete)
+    size_after = storage_size(data_dir)
+
+    return {
+        'clients': clients,
+        **{name: phase.report() for name, phase in phases.items()},
+        'storage': {
+            'before_bytes': size_before,
+            'after_upload_bytes': size_after_upload,
+            'after_bytes': size_after,
+            'uploaded_bytes': sum(len(post) for post in posts),
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def wait_for_server(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('uvicorn exited before it started serving')
+            try:
+                await client.get(f'{url}/html/missing')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError('uvicorn did not start in time')
+
+
+async def run_suite(args, data_dir: str) -> List[dict]:
+    template = load_template()
+    rnd = random.Random(args.seed)
+    levels = [int(x) for x in args.clients.split(',')]
+    phase_names = [name for name in PHASES if name in args.phases.split(',')]
+    results = []
+    process = None  # type: Optional[subprocess.Popen]
+
+    if args.server == 'uvicorn':
+        port = free_port()
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'htmlshare:app', '--port', str(port),
+                                    '--log-level', 'warning'], cwd=ROOT)
+        base_url = f'http://127.0.0.1:{port}'
+        await wait_for_server(base_url, process)
+        client = httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=max(levels)))
+    else:
+        import htmlshare
+        await htmlshare.app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=htmlshare.app), base_url='http://htmlshare')
+
+    try:
+        for clients in levels:
+            if args.size:
+                posts = [fixed_size_post(args.size)] * args.uploads
+            else:
+                posts = [generate_post(template, rnd) for _ in range(args.uploads)]
+            result = await run_level(client, clients, posts, args.reads, data_dir, phase_names)
+            results.append(result)
+            print(f'{clients:>4} clients: ' + ', '.join(
+                f'{name} {result[name]["rps"]} req/s (p50 {result[name]["p50_ms"]} ms, p99 {result[name]["p99_ms"]} ms)'
+                for name in phase_names
+            ) + f', storage {result["storage"]["after_bytes"] / 1024 / 1024:.1f} MB')
+    finally:
+        await client.aclose()
+        if process is not None:
+            process.terminate()
+            process.wait()
+        else:
+            await htmlshare.app.router.shutdown()
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark htmlshare service')
+    parser.add_argument('--server', choices=('asgi', 'uvicorn'), default='asgi',
+                        help='Call app in-process or run it with uvicorn in subprocess')
+    parser.add_argument('--clients', default='1,4,16,64,256', help='Comma separated concurrency levels')
+    parser.add_argument('--uploads', type=int, default=500, help='Documents uploaded at each level')
+    parser.add_argument('--reads', type=int, default=2000, help='Reads at each level')
+    parser.add_argument('--size', type=int, default=0,
+                        help='Upload documents of this size (bytes) instead of generated posts of mixed sizes')
+    parser.add_argument('--phases', default=','.join(PHASES), help='Comma separated phases to measure')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', dest='json_path', default=None, help='Write report as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ['HTMLSHARE_DB_PATH'] = os.path.join(data_dir, 'html_database.db')
+        os.environ['HTMLSHARE_BLOB_DIR'] = os.path.join(data_dir, 'html_blobs')
+        os.environ['HTMLSHARE_PASSWORD'] = PASSWORD
+        os.environ['HTMLSHARE_RATE_LIMIT_TIMES'] = str(10 ** 9)
+        sys.path.insert(0, ROOT)
+        started = time.time()
+        results = asyncio.run(run_suite(args, data_dir))
+
+    report = {
+        'benchmark': 'htmlshare',
+        'commit': git_commit(),
+        'started_at': started,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': args.server,
+        'uploads_per_level': args.uploads,
+        'upload_size': args.size or None,
+        'phases': [name for name in PHASES if name in args.phases.split(',')],
+        'reads_per_level': args.reads,
+        'seed': args.seed,
+        'levels': results,
+    }
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
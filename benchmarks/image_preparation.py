@@ -0,0 +1,127 @@
+# Benchmark: recompressing/downscaling photos before Telegraph upload. Compares doing it right in event loop with
+# ProcessPoolExecutor (used by ImagePreparer) and reports CPU time, wall time, event loop lag and bytes saved.
+# Run from repo root:
+#   python benchmarks/image_preparation.py                   # synthetic photo set
+#   python benchmarks/image_preparation.py --photos ~/photos  # your own JPEGs
+import argparse
+import asyncio
+import io
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    from PIL import Image, ImageDraw, ImageFilter
+except ImportError:
+    # Pillow is optional for the bot (see src/images.py), but this benchmark can't run without it
+    sys.exit('This benchmark needs Pillow: pip install Pillow')
+
+from images import READING_MODE_WIDTH, recompress_jpeg  # noqa: E402
+
+
+def synthetic_photo(width: int, height: int, seed: int) -> bytes:
+    rnd = random.Random(seed)
+    image = Image.effect_noise((width, height), 64).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        r = rnd.randrange(20, width // 4)
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=color)
+    image = image.filter(ImageFilter.GaussianBlur(2))
+    result = io.BytesIO()
+    # Telegram serves photos with roughly this quality
+    image.save(result, 'JPEG', quality=87)
+    return result.getvalue()
+
+
+def load_photos(path: str, count: int) -> List[bytes]:
+    if path:
+        names = sorted(name for name in os.listdir(path) if name.lower().endswith(('.jpg', '.jpeg')))[:count]
+        photos = []
+        for name in names:
+            with open(os.path.join(path, name), 'rb') as f:
+                photos.append(f.read())
+        return photos
+    sizes = [(2560, 1920), (1280, 960), (1920, 1080), (1280, 1707)]
+    return [synthetic_photo(*sizes[i % len(sizes)], seed=i) for i in range(count)]
+
+
+async def measure_lag(stop: asyncio.Event, lags: List[float], interval: float = 0.005):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run_mode(photos: List[bytes], max_width: int, quality: int, pool) -> dict:
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    lags = []
+    lag_task = asyncio.create_task(measure_lag(stop, lags))
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+
+    if pool is None:
+        results = []
+        for photo in photos:
+            results.append(recompress_jpeg(photo, max_width, quality))
+            await asyncio.sleep(0)
+    else:
+        results = await asyncio.gather(*[
+            loop.run_in_executor(pool, recompress_jpeg, photo, max_width, quality) for photo in photos
+        ])
+
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    stop.set()
+    await lag_task
+    return {
+        'elapsed': elapsed,
+        'main_process_cpu': cpu,
+        'max_lag': max(lags) if lags else elapsed,
+        'before': sum(len(p) for p in photos),
+        'after': sum(min(len(p), len(r)) for p, r in zip(photos, results)),
+    }
+
+
+def report(name: str, stats: dict, count: int):
+    print(f'{name:<14} wall {stats["elapsed"]:.2f}s ({stats["elapsed"] / count * 1000:.0f} ms/photo), '
+          f'main process CPU {stats["main_process_cpu"]:.2f}s, max event loop lag {stats["max_lag"] * 1000:.0f} ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Measure image preparation cost')
+    parser.add_argument('--photos', default='', help='Directory with JPEGs, synthetic photos are used if not set')
+    parser.add_argument('--count', type=int, default=16)
+    parser.add_argument('--pixel-ratio', type=float, default=1.5)
+    parser.add_argument('--quality', type=int, default=82)
+    parser.add_argument('--workers', type=int, default=min(2, os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    photos = load_photos(args.photos, args.count)
+    max_width = int(READING_MODE_WIDTH * args.pixel_ratio)
+    print(f'{len(photos)} photos, {sum(len(p) for p in photos) / 1024 / 1024:.1f} MB, target width {max_width}px')
+
+    inline = await run_mode(photos, max_width, args.quality, None)
+    report('in event loop', inline, len(photos))
+
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # Warm up workers, so process start isn't counted
+        await asyncio.get_running_loop().run_in_executor(pool, recompress_jpeg, photos[0], max_width, args.quality)
+        pooled = await run_mode(photos, max_width, args.quality, pool)
+    report(f'{args.workers} processes', pooled, len(photos))
+
+    saved = pooled['before'] - pooled['after']
+    print(f'bytes: {pooled["before"]} -> {pooled["after"]}, saved {saved / 1024 / 1024:.1f} MB '
+          f'({saved / pooled["before"] * 100:.0f}%)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,321 @@
+# Offline load test: replays scripted update streams from N simulated users through RaindropioBot's dispatcher
+# while every external service is replaced with local mock (see mock_services.py).
+# Run from repo root:
+#   python benchmarks/load_test.py --users 50 --steps 20 --latency 0.05 --error-rate 0.01
+# If MONGO_HOST isn't set, users and FSM state are kept in memory.
+import argparse
+import asyncio
+import functools
+import importlib
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from mock_services import ServiceProfile, all_services  # noqa: E402
+
+BOT_TOKEN = '123456:LOAD-TEST-TOKEN'
+SCENARIOS = ('link', 'forward', 'attachment', 'inline')
+
+
+class MemoryCollection:
+    # Just enough of motor collection for what bot does with users
+    def __init__(self):
+        self.documents = {}
+
+    @staticmethod
+    def _matches(document: dict, query: dict) -> bool:
+        return all(document.get(key) == value for key, value in query.items() if not isinstance(value, dict))
+
+    async def find_one(self, query: dict) -> Optional[dict]:
+        for document in self.documents.values():
+            if self._matches(document, query):
+                return dict(document)
+        return None
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        document = self.documents.get(query.get('_id'))
+        if document is None and upsert:
+            document = self.documents[query['_id']] = {'_id': query['_id']}
+        if document is not None:
+            document.update(update.get('$set', {}))
+
+    async def count_documents(self, query: dict) -> int:
+        return len(self.documents)
+
+    async def create_indexes(self, indexes):
+        pass
+
+
+class MemoryDatabase(dict):
+    def __missing__(self, key):
+        self[key] = MemoryCollection()
+        return self[key]
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {}  # type: Dict[str, List[float]]
+        self.updates = 0
+        self.errors = 0
+
+    def add(self, name: str, elapsed: float):
+        self.timings.setdefault(name, []).append(elapsed)
+
+    def wrap(self, func):
+        @functools.wraps(func)
+        async def wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(func.__name__, time.perf_counter() - started)
+        return wrapped
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+
+    def _message(self, user_id: int, **fields) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+        }
+        message.update(fields)
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def link(self, user_id: int) -> dict:
+        return self._message(user_id, text=f'https://example.com/articles/{random.randint(1, 10 ** 9)}')
+
+    def forwarded(self, user_id: int, channel_id: int, with_photo: bool = False) -> dict:
+        text = 'Long post from channel. ' * random.randint(10, 60)
+        fields = {
+            'forward_from_chat': {'id': channel_id, 'type': 'channel', 'title': f'Channel {channel_id}',
+                                  'username': f'channel{channel_id}'},
+            'forward_date': int(time.time()),
+        }
+        if with_photo:
+            file_id = f'photo{next(self.file_ids)}'
+            fields['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960,
+                                'file_size': 120000}]
+            fields['caption'] = text
+        else:
+            fields['text'] = text
+        return self._message(user_id, **fields)
+
+    def attachment(self, user_id: int) -> dict:
+        file_id = f'photo{next(self.file_ids)}'
+        return self._message(user_id, caption='Photo saved from load test', photo=[
+            {'file_id': f'{file_id}s', 'file_unique_id': f'{file_id}s', 'width': 320, 'height': 240,
+             'file_size': 12000},
+            {'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960, 'file_size': 120000},
+        ])
+
+    def inline(self, user_id: int, query: str) -> dict:
+        return {'update_id': next(self.update_ids), 'inline_query': {
+            'id': str(next(self.update_ids)),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}'},
+            'query': query,
+            'offset': '',
+        }}
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.recorder = Recorder()
+        self.factory = UpdateFactory()
+        self.services = all_services(ServiceProfile(args.latency, args.jitter, args.error_rate))
+        self.bot = None
+        self.pending = set()
+
+    async def start_bot(self):
+        telegram_url = self.services['telegram'].url
+        os.environ.update({
+            'BOT_TOKEN': BOT_TOKEN,
+            'BOT_SERVER_URL': telegram_url,
+            'RAINDROP_API_URL': f'{self.services["raindrop"].url}/rest',
+            'HTMLSHARE_BASE_URL': self.services['htmlshare'].url,
+            'HTMLSHARE_PASSWORD': 'load-test',
+            'TELEGRAPH_TOKEN': 'load-test',
+        })
+        os.environ.setdefault('MONGO_PORT', '27017')
+        main = importlib.import_module('main')
+        db_module = importlib.import_module('db')
+        from aiogram import Bot, Dispatcher
+        from bson import ObjectId
+
+        self.bot = main.RaindropioBot(asyncio.get_running_loop())
+        # Mock server hands out files over HTTP the same way api.telegram.org does
+        self.bot.using_default_bot_server = True
+        # aiograph allows only https services, so we point it to the mock directly
+        self.bot.telegraph._service_url = self.services['telegraph'].url
+
+        if os.getenv('MONGO_HOST'):
+            db = None
+        else:
+            from aiogram.contrib.fsm_storage.memory import MemoryStorage
+            db = MemoryDatabase()
+            self.bot.dispatcher.storage = MemoryStorage()
+        await self.bot.setup(db)
+
+        for user_id in self.user_ids():
+            user = db_module.User(id=ObjectId(), telegram_id=user_id, raindrop_api_key=f'token-{user_id}')
+            await user.save(self.bot.db)
+
+        for handlers in (self.bot.dispatcher.message_handlers, self.bot.dispatcher.inline_query_handlers,
+                         self.bot.dispatcher.callback_query_handlers):
+            for handler_obj in handlers.handlers:
+                handler_obj.handler = self.recorder.wrap(handler_obj.handler)
+
+        Bot.set_current(self.bot.bot)
+        Dispatcher.set_current(self.bot.dispatcher)
+
+    def user_ids(self) -> range:
+        return range(10 ** 6, 10 ** 6 + self.args.users)
+
+    async def feed(self, raw_update: dict):
+        from aiogram import types as tgtypes
+        update = tgtypes.Update(**raw_update)
+        started = time.perf_counter()
+        try:
+            await self.bot.dispatcher.process_update(update)
+        except Exception:
+            self.recorder.errors += 1
+        finally:
+            self.recorder.updates += 1
+            self.recorder.add('update (end-to-end)', time.perf_counter() - started)
+
+    def dispatch(self, raw_update: dict) -> asyncio.Task:
+        # Polling also starts separate task for every update, so we do the same
+        task = asyncio.create_task(self.feed(raw_update))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def run_user(self, user_id: int, weights: List[float]):
+        for _ in range(self.args.steps):
+            scenario = random.choices(SCENARIOS, weights)[0]
+            tasks = []
+            if scenario == 'link':
+                tasks.append(self.dispatch(self.factory.link(user_id)))
+            elif scenario == 'attachment':
+                tasks.append(self.dispatch(self.factory.attachment(user_id)))
+            elif scenario == 'forward':
+                channel_id = -random.randint(10 ** 9, 2 * 10 ** 9)
+                for index in range(random.randint(2, self.args.stack_size)):
+                    tasks.append(self.dispatch(self.factory.forwarded(user_id, channel_id, with_photo=index == 0)))
+                    await asyncio.sleep(0.01)
+            else:
+                word = random.choice(['python', 'asyncio', 'raindrop', 'telegram'])
+                for length in range(1, len(word) + 1):
+                    tasks.append(self.dispatch(self.factory.inline(user_id, word[:length])))
+                    await asyncio.sleep(random.uniform(0.05, 0.2))
+            await asyncio.gather(*tasks)
+            await asyncio.sleep(random.uniform(0, self.args.think_time))
+
+    async def run(self) -> dict:
+        for service in self.services.values():
+            await service.start()
+        try:
+            await self.start_bot()
+            weights = [self.args.mix.get(name, 0) for name in SCENARIOS]
+            started = time.perf_counter()
+            await asyncio.gather(*[self.run_user(user_id, weights) for user_id in self.user_ids()])
+            while self.pending:
+                await asyncio.gather(*list(self.pending))
+            elapsed = time.perf_counter() - started
+        finally:
+            if self.bot is not None:
+                await self.bot.bot.close()
+                await self.bot.telegraph.close()
+            for service in self.services.values():
+                await service.stop()
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            'users': self.args.users,
+            'steps': self.args.steps,
+            'elapsed_s': round(elapsed, 3),
+            'updates': self.recorder.updates,
+            'update_errors': self.recorder.errors,
+            'throughput_updates_per_s': round(self.recorder.updates / elapsed, 2) if elapsed else 0,
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'handlers': {
+                name: {
+                    'count': len(values),
+                    'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                    'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+                } for name, values in sorted(self.recorder.timings.items())
+            },
+            'upstream': {name: dict(service.stats) for name, service in self.services.items()},
+        }
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Unknown scenario {name}, expected one of {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def print_report(report: dict):
+    print(f'{report["updates"]} updates from {report["users"]} users in {report["elapsed_s"]}s: '
+          f'{report["throughput_updates_per_s"]} updates/s, {report["update_errors"]} errors, '
+          f'peak RSS {report["peak_rss_mb"]} MB')
+    print(f'{"handler":<28}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}')
+    for name, stats in report['handlers'].items():
+        print(f'{name:<28}{stats["count"]:>8}{stats["p50_ms"]:>10}{stats["p99_ms"]:>10}')
+    for name, stats in report['upstream'].items():
+        print(f'{name:<10} requests: {stats.get("requests", 0)}, injected errors: {stats.get("errors", 0)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load test of Raindrop bot')
+    parser.add_argument('--users', type=int, default=20, help='Number of concurrent simulated users')
+    parser.add_argument('--steps', type=int, default=10, help='Scenarios each user runs')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('link=4,forward=2,attachment=1,inline=3'),
+                        help='Weights of scenarios, e.g. link=4,forward=2,attachment=1,inline=3')
+    parser.add_argument('--stack-size', type=int, default=5, help='Max number of messages in forwarded stack')
+    parser.add_argument('--think-time', type=float, default=0.5, help='Max pause between user scenarios, seconds')
+    parser.add_argument('--latency', type=float, default=0.02, help='Base latency of mock services, seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Random extra latency of mock services, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of mock service returning 500')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write report as JSON to this file')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    report = asyncio.run(LoadTest(args).run())
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
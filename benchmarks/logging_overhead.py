@@ -0,0 +1,97 @@
+# Benchmark: time event loop spends on logging per update with different logging setups. Every mode runs in its
+# own process, because logging is configured from environment when loggers are created.
+# Run from repo root:
+#   python benchmarks/logging_overhead.py --updates 20000
+#   python benchmarks/logging_overhead.py --updates 5000 --sink-delay-us 50  # slow stdout
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+MODES = {
+    # Setup before this change: f-strings and synchronous handler on event loop thread
+    'eager-sync': {'style': 'eager', 'env': {}},
+    'lazy-sync': {'style': 'lazy', 'env': {}},
+    'lazy-queue': {'style': 'lazy', 'env': {'LOG_QUEUE': 'true'}},
+    'lazy-queue-sampled': {'style': 'lazy', 'env': {'LOG_QUEUE': 'true', 'LOG_SAMPLING': 'bot.updates=0.01'}},
+}
+
+
+class SlowStream:
+    # Stands for stdout which blocks, e.g. when docker log driver or terminal can't keep up
+    def __init__(self, stream, delay: float):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, data: str):
+        time.sleep(self.delay)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+async def child(updates: int, style: str, sink_delay: float) -> dict:
+    if sink_delay:
+        sys.stderr = SlowStream(sys.stderr, sink_delay)
+    from utils import get_logger
+
+    logger = get_logger('bot')
+    updates_logger = get_logger('bot.updates')
+    # Same records bot writes while handling a link and an inline query, debug ones are filtered by LOG_LEVEL
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    for i in range(updates):
+        user_id, link = 1000000 + i % 500, f'https://example.com/article/{i}'
+        if style == 'eager':
+            updates_logger.info(f'Processing message from user {user_id}')
+            logger.info(f'Got link {link}')
+            updates_logger.info(f'Pre processing inline query from {user_id}')
+            logger.debug(f'Inline query {i} superseded by newer one')
+        else:
+            updates_logger.info('Processing message from user %s', user_id)
+            logger.info('Got link %s', link)
+            updates_logger.info('Pre processing inline query from %s', user_id)
+            logger.debug('Inline query %s superseded by newer one', i)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    return {'per_update_us': elapsed / updates * 1e6, 'cpu_per_update_us': cpu / updates * 1e6}
+
+
+def run_mode(name: str, updates: int, log_path: str, sink_delay_us: int) -> dict:
+    mode = MODES[name]
+    env = {**os.environ, 'LOG_LEVEL': 'INFO', 'LOG_QUEUE': 'false', 'LOG_SAMPLING': '', **mode['env']}
+    with open(log_path, 'a') as log:
+        output = subprocess.check_output([sys.executable, __file__, '--child', mode['style'], '--updates', str(updates),
+                                          '--sink-delay-us', str(sink_delay_us)], env=env, stderr=log, text=True)
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure logging overhead per update')
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--log', default=os.devnull, help='Where child processes write logs, e.g. file on real disk')
+    parser.add_argument('--sink-delay-us', type=int, default=0, help='Simulate blocking log output, per write')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, SRC)
+        print(json.dumps(asyncio.run(child(args.updates, args.child, args.sink_delay_us / 1e6))))
+        return
+
+    for name in MODES:
+        result = run_mode(name, args.updates, args.log, args.sink_delay_us)
+        print(f'{name:<20} {result["per_update_us"]:7.1f} us/update on event loop '
+              f'(process CPU {result["cpu_per_update_us"]:.1f} us/update)')
+
+
+if __name__ == '__main__':
+    main()
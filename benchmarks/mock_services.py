@@ -0,0 +1,279 @@
+# Local stand-ins for services the bot talks to: Telegram Bot API, Raindrop REST, Telegraph and htmlshare.
+# Each of them can add latency and fail with given probability, which is enough to see how bot behaves under load
+# without real tokens. Used by load_test.py, but can be started on its own too:
+#   python benchmarks/mock_services.py --latency 0.05 --error-rate 0.01
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+# Small valid JPEG served for every file download
+SAMPLE_JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e1d'
+    '1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001050101'
+    '0101010100000000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d010203000411051221314106'
+    '13516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a535455'
+    '565758595a636465666768696a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9ba'
+    'c2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3ffd9'
+)
+
+
+@dataclass
+class ServiceProfile:
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+
+
+def profile_middleware(profile: ServiceProfile, stats: Dict[str, int]):
+    @web.middleware
+    async def middleware(request: web.Request, handler):
+        stats['requests'] = stats.get('requests', 0) + 1
+        delay = profile.latency + random.uniform(0, profile.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if profile.error_rate and random.random() < profile.error_rate:
+            stats['errors'] = stats.get('errors', 0) + 1
+            return web.json_response({'ok': False, 'result': False, 'error_code': 500,
+                                      'description': 'Injected error'}, status=500)
+        return await handler(request)
+    return middleware
+
+
+class MockService:
+    name = 'service'
+
+    def __init__(self, profile: Optional[ServiceProfile] = None):
+        self.profile = profile or ServiceProfile()
+        self.stats = {}  # type: Dict[str, int]
+        self.runner = None  # type: Optional[web.AppRunner]
+        self.url = ''
+
+    def routes(self) -> List[web.RouteDef]:
+        raise NotImplementedError
+
+    def build_app(self) -> web.Application:
+        app = web.Application(middlewares=[profile_middleware(self.profile, self.stats)], client_max_size=200 * 2 ** 20)
+        app.add_routes(self.routes())
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self.runner = web.AppRunner(self.build_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound_host, bound_port = self.runner.addresses[0][:2]
+        self.url = f'http://{bound_host}:{bound_port}'
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class MockBotApi(MockService):
+    # Answers Bot API methods bot actually uses. Served at {url}/bot{token}/{method} like api.telegram.org
+    name = 'telegram'
+
+    def __init__(self, profile: Optional[ServiceProfile] = None):
+        super().__init__(profile)
+        self.message_ids = itertools.count(10 ** 6)
+        self.calls = {}  # type: Dict[str, int]
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/bot{token}/{method}', self.handle_method),
+            web.get('/bot{token}/{method}', self.handle_method),
+            web.get('/file/bot{token}/{path:.+}', self.handle_file),
+        ]
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.method == 'POST' else dict(request.query)
+        return web.json_response({'ok': True, 'result': self.result_for(method.lower(), params)})
+
+    def result_for(self, method: str, params: dict):
+        if method in ('sendmessage', 'editmessagetext'):
+            chat_id = int(params.get('chat_id', 0))
+            return {
+                'message_id': int(params.get('message_id') or next(self.message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Raindrop bot'},
+                'text': params.get('text', ''),
+            }
+        if method == 'getfile':
+            file_id = params.get('file_id', 'file')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(SAMPLE_JPEG),
+                    'file_path': f'photos/{file_id}.jpg'}
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Raindrop bot', 'username': 'raindropiobot'}
+        return True
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls['file'] = self.calls.get('file', 0) + 1
+        return web.Response(body=SAMPLE_JPEG, content_type='image/jpeg')
+
+
+def fake_raindrop(raindrop_id: int, link: str, title: str = '', collection_id: int = -1) -> dict:
+    now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+    return {
+        '_id': raindrop_id,
+        'collectionId': collection_id,
+        'collection': {'$id': collection_id},
+        'cover': '',
+        'created': now,
+        'lastUpdate': now,
+        'domain': 'example.com',
+        'title': title or f'Raindrop {raindrop_id}',
+        'excerpt': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit',
+        'link': link,
+        'media': [],
+        'tags': [],
+        'type': 'link',
+    }
+
+
+class MockRaindrop(MockService):
+    # Served at {url}/rest/v1/..., pass {url}/rest as RAINDROP_API_URL
+    name = 'raindrop'
+
+    def __init__(self, profile: Optional[ServiceProfile] = None, total_raindrops: int = 500):
+        super().__init__(profile)
+        self.ids = itertools.count(1)
+        self.total_raindrops = total_raindrops
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get('/rest/v1/user', self.get_user),
+            web.get('/rest/v1/raindrops/{collection_id}', self.get_raindrops),
+            web.post('/rest/v1/raindrop', self.create_raindrop),
+            web.post('/rest/v1/raindrops', self.create_raindrops),
+            web.put('/rest/v1/raindrop/{id}/file', self.upload_file),
+            web.put('/rest/v1/raindrop/{id}', self.update_raindrop),
+            web.delete('/rest/v1/raindrop/{id}', self.delete_raindrop),
+            web.post('/rest/v1/import/url/exists', self.url_exists),
+            web.get('/rest/v1/collections', self.get_collections),
+            web.get('/rest/v1/collections/childrens', self.get_child_collections),
+        ]
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        return web.json_response({'result': True, 'user': {'_id': 1, 'fullName': 'Load test'}})
+
+    async def get_raindrops(self, request: web.Request) -> web.Response:
+        page = int(request.query.get('page', 0))
+        per_page = int(request.query.get('perpage', 50))
+        search = request.query.get('search', '')
+        first = page * per_page
+        last = min(first + per_page, self.total_raindrops)
+        items = [fake_raindrop(i, f'https://example.com/{search}/{i}', f'{search} result {i}')
+                 for i in range(first, last)]
+        return web.json_response({'result': True, 'items': items, 'count': self.total_raindrops})
+
+    async def create_raindrop(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        collection_id = payload.get('collection', {}).get('$id', -1)
+        item = fake_raindrop(next(self.ids), payload['link'], payload.get('title') or '', collection_id)
+        return web.json_response({'result': True, 'item': item})
+
+    async def create_raindrops(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        items = [fake_raindrop(next(self.ids), item['link']) for item in payload['items']]
+        return web.json_response({'result': True, 'items': items})
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response({'result': True})
+
+    async def update_raindrop(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        collection_id = payload.get('collection', {}).get('$id', -1)
+        item = fake_raindrop(int(request.match_info['id']), 'https://example.com', collection_id=collection_id)
+        return web.json_response({'result': True, 'item': item})
+
+    async def delete_raindrop(self, request: web.Request) -> web.Response:
+        return web.json_response({'result': True})
+
+    async def url_exists(self, request: web.Request) -> web.Response:
+        await request.json()
+        return web.json_response({'result': False, 'ids': []})
+
+    async def get_collections(self, request: web.Request) -> web.Response:
+        items = [{'_id': 1000 + i, 'title': f'Collection {i}', 'count': 10, 'lastUpdate': '2021-09-25T12:14:32.542Z'}
+                 for i in range(5)]
+        return web.json_response({'result': True, 'items': items})
+
+    async def get_child_collections(self, request: web.Request) -> web.Response:
+        items = [{'_id': 2000 + i, 'title': f'Child {i}', 'count': 3, 'parent': {'$id': 1000},
+                  'lastUpdate': '2021-09-25T12:14:32.542Z'} for i in range(3)]
+        return web.json_response({'result': True, 'items': items})
+
+
+class MockTelegraph(MockService):
+    name = 'telegraph'
+
+    def routes(self) -> List[web.RouteDef]:
+        return [web.post('/upload', self.upload)]
+
+    async def upload(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response([{'src': f'/file/{uuid.uuid4().hex}.jpg'}])
+
+
+class MockHtmlshare(MockService):
+    name = 'htmlshare'
+
+    def __init__(self, profile: Optional[ServiceProfile] = None):
+        super().__init__(profile)
+        self.records = {}  # type: Dict[str, str]
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.post('/html', self.upload_html),
+            web.get('/html/{id}', self.get_html),
+        ]
+
+    async def upload_html(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        record_id = str(uuid.uuid4())
+        # Only size is kept, there is no need to hold all posts in memory during long runs
+        self.records[record_id] = str(len(payload['html']))
+        return web.json_response({'id': record_id})
+
+    async def get_html(self, request: web.Request) -> web.Response:
+        if request.match_info['id'] not in self.records:
+            raise web.HTTPNotFound()
+        return web.Response(text='<html></html>', content_type='text/html')
+
+
+def all_services(profile: ServiceProfile) -> Dict[str, MockService]:
+    services = [MockBotApi(profile), MockRaindrop(profile), MockTelegraph(profile), MockHtmlshare(profile)]
+    return {service.name: service for service in services}
+
+
+async def serve_forever(profile: ServiceProfile):
+    services = all_services(profile)
+    for service in services.values():
+        await service.start()
+        print(f'{service.name:<10} {service.url}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for service in services.values():
+            await service.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start mock Telegram, Raindrop, Telegraph and htmlshare servers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Base latency of every request, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of 500 response')
+    args = parser.parse_args()
+    asyncio.run(serve_forever(ServiceProfile(args.latency, args.jitter, args.error_rate)))
@@ -0,0 +1,76 @@
+# Microbenchmark: parsing /v1/raindrops response with 50 items and building inline results from it.
+# Compares full pydantic models built from stdlib json against RaindropLite built from json_loads.
+# Run from repo root: python benchmarks/raindrop_results.py
+import json
+import os
+import sys
+import timeit
+
+os.environ.setdefault('MONGO_PORT', '27017')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from raindrop_api import Raindrop, RaindropLite, RaindropApi  # noqa: E402
+from utils import drops_to_inline_results, json_loads, orjson  # noqa: E402
+
+ITEMS = 50
+ROUNDS = 2000
+
+
+def make_payload(count: int = ITEMS) -> bytes:
+    items = []
+    for i in range(count):
+        items.append({
+            '_id': 100000 + i,
+            'collectionId': -1,
+            'collection': {'$id': -1},
+            'cover': f'https://rdl.ink/render/https%3A%2F%2Fexample.com%2Fpost-{i}',
+            'created': '2021-09-25T12:14:32.542Z',
+            'lastUpdate': '2021-09-26T08:01:11.109Z',
+            'domain': 'example.com',
+            'title': f'Some pretty long title of the article number {i}',
+            'excerpt': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor ' * 3,
+            'link': f'https://example.com/post-{i}',
+            'media': [{'link': f'https://example.com/post-{i}.png', 'type': 'image'}],
+            'tags': ['telegram', 'saved'],
+            'type': 'article',
+            'user': {'$id': 1},
+            'sort': i,
+            'removed': False,
+        })
+    return json.dumps({'result': True, 'items': items, 'count': count}).encode()
+
+
+def run_full(payload: bytes, api: RaindropApi):
+    js = json.loads(payload)
+    drops = [Raindrop(api=api, **drop) for drop in js['items']]
+    return drops_to_inline_results(drops)
+
+
+def run_lite(payload: bytes):
+    js = json_loads(payload)
+    drops = [RaindropLite(drop) for drop in js['items']]
+    return drops_to_inline_results(drops)
+
+
+def run_lite_parse_only(payload: bytes):
+    js = json_loads(payload)
+    return [RaindropLite(drop) for drop in js['items']]
+
+
+def main():
+    payload = make_payload()
+    api = RaindropApi('benchmark')
+    print(f'{ITEMS} items, {len(payload)} bytes, {ROUNDS} rounds, orjson: {"yes" if orjson else "no"}')
+
+    cases = [
+        ('full pydantic + results', lambda: run_full(payload, api)),
+        ('lite + results', lambda: run_lite(payload)),
+        ('lite parse only', lambda: run_lite_parse_only(payload)),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=ROUNDS, repeat=5))
+        print(f'{name:<28} {best / ROUNDS * 1e6:10.1f} us/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,15 @@
+import argparse
+import asyncio
+import hashlib
+import queue
+import threading
 import time
+from html.parser import HTMLParser
+from typing import Optional
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from fastapi.responses import HTMLResponse, JSONResponse
-from threading import local
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
 import sqlite3
 import uuid
 import os
@@ -14,6 +21,9 @@ app = FastAPI()
 class HtmlUploadRequest(BaseModel):
     html: str
     password: str
+    # Optional, used only by search
+    title: Optional[str] = None
+    owner: Optional[str] = None
 
 # Define schema for outgoing response
 class HtmlUploadResponse(BaseModel):
@@ -23,32 +33,485 @@ class HtmlUploadResponse(BaseModel):
 class HtmlGetResponse(BaseModel):
     html: str
 
-RATE_LIMIT_TIMES = 30
+RATE_LIMIT_TIMES = int(os.environ.get("HTMLSHARE_RATE_LIMIT_TIMES", 30))
 RATE_LIMIT_SECONDS = 60
 rate_limits = {}
 
-sqlite_storage = local()
+DB_PATH = os.environ.get("HTMLSHARE_DB_PATH", "html_database.db")
+# Writes are grouped into single transaction, which is committed after this many operations or this many seconds
+WRITE_BATCH_SIZE = int(os.environ.get("HTMLSHARE_WRITE_BATCH_SIZE", 64))
+WRITE_BATCH_DELAY = float(os.environ.get("HTMLSHARE_WRITE_BATCH_DELAY", 0.004))
+READ_POOL_SIZE = int(os.environ.get("HTMLSHARE_READ_POOL_SIZE", 4))
 
-def get_sqlite_conn():
-    if not hasattr(sqlite_storage, "conn"):
-        sqlite_storage.conn = sqlite3.connect("html_database.db")
-    return sqlite_storage.conn
+RUN_IN_DOCKER = os.environ.get("RUN_IN_DOCKER", "false") == "true"
+DATA_DIR = os.environ.get("HTMLSHARE_DATA_DIR", "/app_data" if RUN_IN_DOCKER else ".")
+# Bodies bigger than threshold are stored as files named by their content hash, only metadata stays in SQLite
+BLOB_DIR = os.environ.get("HTMLSHARE_BLOB_DIR", os.path.join(DATA_DIR, "html_blobs"))
+BLOB_THRESHOLD = int(os.environ.get("HTMLSHARE_BLOB_THRESHOLD", 64 * 1024))
+blob_locks = []
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    if hasattr(sqlite_storage, "conn"):
-        sqlite_storage.conn.close()
+# Reads only remember access time, it's written to database in batches every LAST_ACCESS_FLUSH_INTERVAL seconds
+LAST_ACCESS_FLUSH_INTERVAL = float(os.environ.get("HTMLSHARE_LAST_ACCESS_FLUSH_INTERVAL", 60))
+# Documents nobody has read for this many days are deleted. 0 disables expiry
+TTL_DAYS = float(os.environ.get("HTMLSHARE_TTL_DAYS", 0))
+# Compactor frees at most COMPACT_STEP_PAGES pages at once and then lets other queries run
+COMPACT_INTERVAL = float(os.environ.get("HTMLSHARE_COMPACT_INTERVAL", 60))
+COMPACT_STEP_PAGES = int(os.environ.get("HTMLSHARE_COMPACT_STEP_PAGES", 128))
+COMPACT_MIN_FREE_PAGES = int(os.environ.get("HTMLSHARE_COMPACT_MIN_FREE_PAGES", 1024))
+EXPIRE_BATCH_SIZE = 100
+# Full-text search over documents text, needs SQLite built with FTS5. Documents uploaded before index existed are
+# indexed in background, SEARCH_BACKFILL_BATCH_SIZE at once
+SEARCH_ENABLED = os.environ.get("HTMLSHARE_SEARCH", "true") == "true"
+SEARCH_BACKFILL_BATCH_SIZE = int(os.environ.get("HTMLSHARE_SEARCH_BACKFILL_BATCH_SIZE", 100))
+SEARCH_MAX_RESULTS = 50
+last_accessed = {}
+background_tasks = []
 
-@app.on_event("startup")
-async def shutdown_event():
-    conn = get_sqlite_conn()
+
+def connect(read_only=False):
+    if read_only:
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+    else:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Otherwise WAL file keeps its biggest size forever, even after compaction
+        conn.execute("PRAGMA journal_size_limit=67108864")
+    return conn
+
+
+# Single thread which owns the only write connection. Operations from all requests are collected into
+# group commits, so concurrent uploads don't fight over SQLite's write lock
+class GroupCommitWriter:
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, batch_delay=WRITE_BATCH_DELAY):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    async def execute(self, sql, params=(), many=False):
+        # Returns number of affected rows
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put((sql, params, many, loop, future))
+        return await future
+
+    async def executemany(self, sql, params):
+        return await self.execute(sql, params, many=True)
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                operation = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if operation is None:
+                # Stop after this batch is committed
+                self.queue.put(None)
+                break
+            batch.append(operation)
+        return batch
+
+    def _run(self):
+        conn = connect()
+        try:
+            while True:
+                operation = self.queue.get()
+                if operation is None:
+                    break
+                batch = self._collect_batch(operation)
+                results = []
+                try:
+                    with conn:
+                        for sql, params, many, _, _ in batch:
+                            try:
+                                cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+                                # Some pragmas (e.g. incremental_vacuum) do their work only while rows are fetched
+                                cursor.fetchall()
+                                results.append(cursor.rowcount)
+                            except sqlite3.Error as e:
+                                results.append(e)
+                except sqlite3.Error as e:
+                    results = [e] * len(batch)
+
+                for (_, _, _, loop, future), result in zip(batch, results):
+                    loop.call_soon_threadsafe(self._resolve, future, result)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _resolve(future, result):
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+# Fixed pool of read-only connections, queries are run in threadpool so event loop isn't blocked
+class ReadPool:
+    def __init__(self, size=READ_POOL_SIZE):
+        self.size = size
+        self.connections = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.opened) < self.size:
+                conn = connect(read_only=True)
+                self.opened.append(conn)
+                return conn
+        return self.connections.get()
+
+    def _fetch(self, sql, params, one):
+        conn = self._acquire()
+        try:
+            cursor = conn.execute(sql, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+        finally:
+            self.connections.put(conn)
+
+    async def fetchone(self, sql, params=()):
+        return await run_in_threadpool(self._fetch, sql, params, True)
+
+    async def fetchall(self, sql, params=()):
+        return await run_in_threadpool(self._fetch, sql, params, False)
+
+    def close(self):
+        with self.lock:
+            for conn in self.opened:
+                conn.close()
+            self.opened = []
+            self.connections = queue.Queue()
+
+
+def init_db(conn):
     c = conn.cursor()
+    # WAL lets readers work while writer commits
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute('''CREATE TABLE IF NOT EXISTS html_records 
              (id TEXT PRIMARY KEY, html TEXT)''')
+    columns = [row[1] for row in c.execute("PRAGMA table_info(html_records)")]
+    if "blob_path" not in columns:
+        c.execute("ALTER TABLE html_records ADD COLUMN blob_path TEXT")
+    if "created_at" not in columns:
+        c.execute("ALTER TABLE html_records ADD COLUMN created_at INTEGER")
+        c.execute("ALTER TABLE html_records ADD COLUMN last_accessed INTEGER")
+        # We don't know real age of old records, so their TTL countdown starts now
+        c.execute("UPDATE html_records SET created_at=?, last_accessed=?", (int(time.time()), int(time.time())))
+    c.execute("CREATE INDEX IF NOT EXISTS html_records_last_accessed ON html_records (last_accessed)")
     conn.commit()
+    init_search_index(conn)
+
+    # Incremental vacuum works only when auto_vacuum is set to INCREMENTAL, switching existing database to it
+    # requires one full VACUUM
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+
+
+def init_search_index(conn):
+    global SEARCH_ENABLED
+    if not SEARCH_ENABLED:
+        return
+    try:
+        # Rows are linked to html_records by rowid. It's not stable only across full VACUUM, which happens just once,
+        # when database is switched to incremental vacuum (index is still empty at that moment)
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS html_search USING fts5"
+                     "(title, body, owner UNINDEXED, tokenize='unicode61 remove_diacritics 2')")
+    except sqlite3.OperationalError as e:
+        print(f"Search is disabled, SQLite doesn't support FTS5: {e}")
+        SEARCH_ENABLED = False
+        return
+    # Covers both deletes by API and expiry
+    conn.execute("CREATE TRIGGER IF NOT EXISTS html_records_search_delete AFTER DELETE ON html_records "
+                 "BEGIN DELETE FROM html_search WHERE rowid=old.rowid; END")
+    conn.commit()
+
+
+class TextExtractor(HTMLParser):
+    SKIPPED_TAGS = {"head", "script", "style", "template", "noscript"}
+    # Dark mode and font toggles of post template
+    SKIPPED_CLASSES = {"toggles"}
+    BLOCK_TAGS = {"p", "div", "br", "li", "blockquote", "pre", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "section",
+                  "article", "main", "figure", "figcaption"}
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        # Number of open elements inside skipped one
+        self.skipped_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        if tag in self.VOID_TAGS:
+            return
+        if self.skipped_depth:
+            self.skipped_depth += 1
+        elif tag in self.SKIPPED_TAGS or self.SKIPPED_CLASSES.intersection((dict(attrs).get("class") or "").split()):
+            self.skipped_depth = 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        if self.skipped_depth and tag not in self.VOID_TAGS:
+            self.skipped_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skipped_depth:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def html_to_text(html):
+    parser = TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+def search_document(html, title=None):
+    # Returns title and body to index. Bot posts have the same <title>, so first line of text is better default
+    body = html_to_text(html)
+    if not title:
+        title = body.split("\n", 1)[0][:100]
+    return title, body
+
+
+def search_query(query):
+    # Every word is quoted, so user input can't break FTS5 query syntax. Last one is matched as prefix,
+    # since query is usually typed right now
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split() if any(c.isalnum() for c in word)]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+async def index_document(record_id, html, title=None, owner=None):
+    if not SEARCH_ENABLED:
+        return
+    title, body = await run_in_threadpool(search_document, html, title)
+    # Backfill might have indexed record between its insert and this call, so existing entry is replaced
+    await writer.execute("INSERT OR REPLACE INTO html_search (rowid, title, body, owner) "
+                         "SELECT rowid, ?, ?, ? FROM html_records WHERE id=?", (title, body, owner, record_id))
+
+
+def read_document(html, blob_path):
+    if blob_path is None:
+        return html
+    try:
+        with open(os.path.join(BLOB_DIR, blob_path), encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return ""
+
+
+def prepare_backfill_batch(rows):
+    return [(rowid,) + search_document(read_document(html, blob_path)) for rowid, html, blob_path in rows]
+
+
+async def backfill_search_index():
+    last_rowid = 0
+    indexed = 0
+    while True:
+        rows = await readers.fetchall("SELECT rowid, html, blob_path FROM html_records WHERE rowid > ? AND NOT EXISTS "
+                                      "(SELECT 1 FROM html_search WHERE html_search.rowid=html_records.rowid) "
+                                      "ORDER BY rowid LIMIT ?", (last_rowid, SEARCH_BACKFILL_BATCH_SIZE))
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        documents = await run_in_threadpool(prepare_backfill_batch, rows)
+        # Owner of old documents is unknown, they are found only by searches without owner.
+        # Row which was deleted meanwhile is skipped by SELECT, so index doesn't get orphans
+        await writer.executemany("INSERT OR IGNORE INTO html_search (rowid, title, body, owner) "
+                                 "SELECT rowid, ?, ?, NULL FROM html_records WHERE rowid=?",
+                                 [(title, body, rowid) for rowid, title, body in documents])
+        indexed += len(rows)
+        # Let uploads use writer between batches
+        await asyncio.sleep(0.05)
+    if indexed:
+        print(f"Indexed {indexed} documents for search")
+
+
+def blob_name(data):
+    digest = hashlib.sha256(data).hexdigest()
+    return os.path.join(digest[:2], f"{digest}.html")
+
+
+def write_blob(data):
+    name = blob_name(data)
+    path = os.path.join(BLOB_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to temporary file first, so readers never see partially written blob
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return name
+
+
+def remove_blob(name):
+    try:
+        os.remove(os.path.join(BLOB_DIR, name))
+    except FileNotFoundError:
+        pass
+
+
+def blob_lock(name):
+    # Serializes writing and removing of the same blob, so deleting one record can't remove file just reused
+    # by concurrent upload of identical content
+    return blob_locks[int(os.path.basename(name)[:8], 16) % len(blob_locks)]
+
+
+async def flush_last_accessed():
+    if not last_accessed:
+        return
+    updates = [(accessed_at, record_id) for record_id, accessed_at in last_accessed.items()]
+    last_accessed.clear()
+    await writer.executemany("UPDATE html_records SET last_accessed=? WHERE id=?", updates)
+
+
+async def expire_records():
+    expire_before = int(time.time() - TTL_DAYS * 24 * 60 * 60)
+    expired = 0
+    while True:
+        rows = await readers.fetchall("SELECT id, blob_path FROM html_records WHERE last_accessed < ? LIMIT ?",
+                                      (expire_before, EXPIRE_BATCH_SIZE))
+        # Skip records which were read recently but access time isn't flushed yet
+        rows = [row for row in rows if row[0] not in last_accessed]
+        if not rows:
+            break
+        await writer.executemany("DELETE FROM html_records WHERE id=?", [(row[0],) for row in rows])
+        for name in {row[1] for row in rows if row[1] is not None}:
+            async with blob_lock(name):
+                still_used = await readers.fetchone("SELECT 1 FROM html_records WHERE blob_path=? LIMIT 1", (name,))
+                if still_used is None:
+                    await run_in_threadpool(remove_blob, name)
+        expired += len(rows)
+        if len(rows) < EXPIRE_BATCH_SIZE:
+            break
+    return expired
+
+
+async def compact():
+    # Each step holds write lock only for a moment, so readers and uploads are never blocked for long
+    free_pages = (await readers.fetchone("PRAGMA freelist_count"))[0]
+    while free_pages > 0:
+        await writer.execute(f"PRAGMA incremental_vacuum({COMPACT_STEP_PAGES})")
+        await asyncio.sleep(0.05)
+        remaining = (await readers.fetchone("PRAGMA freelist_count"))[0]
+        if remaining >= free_pages:
+            break
+        free_pages = remaining
+
+
+async def run_periodically(func, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            print(f"Error in {func.__name__}: {e!r}")
+
+
+async def maintenance():
+    if TTL_DAYS > 0:
+        expired = await expire_records()
+        if expired:
+            print(f"Expired {expired} records")
+    if (await readers.fetchone("PRAGMA freelist_count"))[0] >= COMPACT_MIN_FREE_PAGES:
+        await compact()
+
+
+def get_db_stats():
+    conn = connect(read_only=True)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        records = conn.execute("SELECT COUNT(*) FROM html_records").fetchone()[0]
+    finally:
+        conn.close()
+    wal_path = f"{DB_PATH}-wal"
+    return {
+        "records": records,
+        "page_size": page_size,
+        "page_count": page_count,
+        "free_pages": freelist_count,
+        "db_size_bytes": os.path.getsize(DB_PATH),
+        "wal_size_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+    }
+
+
+writer = GroupCommitWriter()
+readers = ReadPool()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await flush_last_accessed()
+    writer.stop()
+    readers.close()
+
+@app.on_event("startup")
+async def startup_event():
+    conn = connect()
+    init_db(conn)
+    conn.close()
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    blob_locks[:] = [asyncio.Lock() for _ in range(64)]
+    writer.start()
+    background_tasks.append(asyncio.create_task(run_periodically(flush_last_accessed, LAST_ACCESS_FLUSH_INTERVAL)))
+    background_tasks.append(asyncio.create_task(run_periodically(maintenance, COMPACT_INTERVAL)))
+    if SEARCH_ENABLED:
+        background_tasks.append(asyncio.create_task(backfill_search_index()))
+
+def is_authenticated(request: Request) -> bool:
+    # Bot sends password in a header (or in query for GET endpoints), upload body isn't read by middleware
+    password = os.environ.get("HTMLSHARE_PASSWORD")
+    provided = request.headers.get("X-Htmlshare-Password") or request.query_params.get("password")
+    if not password or not provided:
+        return False
+    return hmac.compare_digest(provided.encode("utf-8"), password.encode("utf-8"))
 
 @app.middleware("http")
 async def rate_limiter_middleware(request: Request, call_next):
+    # Limit is meant for public readers. Bot's uploads and searches come from one IP and are paced by bot itself
+    if is_authenticated(request):
+        return await call_next(request)
+
     ip_address = request.client.host
     now = time.time()
     window_start = int(now - RATE_LIMIT_SECONDS)
@@ -80,7 +543,7 @@ async def rate_limiter_middleware(request: Request, call_next):
 
 # Endpoint to upload HTML string and generate ID
 @app.post("/html")
-def upload_html(html_request: HtmlUploadRequest):
+async def upload_html(html_request: HtmlUploadRequest):
     # Generate unique ID for the record
     record_id = str(uuid.uuid4())
 
@@ -94,33 +557,45 @@ def upload_html(html_request: HtmlUploadRequest):
     if not hmac.compare_digest(html_request.password, password):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    conn = get_sqlite_conn()
-    c = conn.cursor()
-    # Insert record into database
-    c.execute("INSERT INTO html_records VALUES (?, ?)", (record_id, html_request.html))
-    conn.commit()
+    now = int(time.time())
+    data = html_request.html.encode("utf-8")
+    if len(data) > BLOB_THRESHOLD:
+        name = blob_name(data)
+        async with blob_lock(name):
+            await run_in_threadpool(write_blob, data)
+            await writer.execute("INSERT INTO html_records (id, html, blob_path, created_at, last_accessed) "
+                                 "VALUES (?, NULL, ?, ?, ?)", (record_id, name, now, now))
+    else:
+        # Insert record into database
+        await writer.execute("INSERT INTO html_records (id, html, created_at, last_accessed) VALUES (?, ?, ?, ?)",
+                             (record_id, html_request.html, now, now))
+
+    await index_document(record_id, html_request.html, html_request.title, html_request.owner)
 
     # Return ID to user
     return HtmlUploadResponse(id=record_id)
 
 # Endpoint to retrieve HTML content by ID
 @app.get("/html/{id}", response_class=HTMLResponse)
-def get_html(id: str):
-    conn = get_sqlite_conn()
-    c = conn.cursor()
+async def get_html(id: str):
     # Check if record exists
-    c.execute("SELECT html FROM html_records WHERE id=?", (id,))
-    record = c.fetchone()
+    record = await readers.fetchone("SELECT html, blob_path FROM html_records WHERE id=?", (id,))
 
     if record is None:
         raise HTTPException(status_code=404, detail="Record not found")
 
+    last_accessed[id] = int(time.time())
+
+    if record[1] is not None:
+        # Large documents are streamed straight from file (with sendfile, if server supports it)
+        return FileResponse(os.path.join(BLOB_DIR, record[1]), media_type="text/html")
+
     # Return HTML content as a response body with content type text/html
     return record[0]
 
 # Endpoint to delete record by ID and password
 @app.delete("/html/{id}")
-def delete_html(id: str, password: str):
+async def delete_html(id: str, password: str):
     # Get password from environment variable
     stored_password = os.environ.get("HTMLSHARE_PASSWORD")
 
@@ -131,20 +606,103 @@ def delete_html(id: str, password: str):
     if not hmac.compare_digest(password, stored_password):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    conn = get_sqlite_conn()
-    c = conn.cursor()
     # Check if record exists
-    c.execute("SELECT * FROM html_records WHERE id=?", (id,))
-    record = c.fetchone()
+    record = await readers.fetchone("SELECT blob_path FROM html_records WHERE id=?", (id,))
 
     if record is None:
         raise HTTPException(status_code=404, detail="Record not found")
 
-    # Delete record from database
-    c.execute("DELETE FROM html_records WHERE id=?", (id,))
-    conn.commit()
+    # Delete record from database, nothing deleted means record was deleted concurrently
+    deleted = await writer.execute("DELETE FROM html_records WHERE id=?", (id,))
+
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Record not found")
+
+    last_accessed.pop(id, None)
+    name = record[0]
+    if name is not None:
+        async with blob_lock(name):
+            # Same content might be shared by several records
+            still_used = await readers.fetchone("SELECT 1 FROM html_records WHERE blob_path=? LIMIT 1", (name,))
+            if still_used is None:
+                await run_in_threadpool(remove_blob, name)
 
     # Return success response
     return {"message": "Record deleted"}
 
-print('App loaded')
\ No newline at end of file
+# Endpoint to check database size and how much space compactor can reclaim
+@app.get("/stats")
+async def get_stats(password: str):
+    stored_password = os.environ.get("HTMLSHARE_PASSWORD")
+
+    if not stored_password:
+        raise ValueError("HTMLSHARE_PASSWORD environment variable not set")
+
+    if not hmac.compare_digest(password, stored_password):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    return await run_in_threadpool(get_db_stats)
+
+# Endpoint to search documents text, results are sorted by relevance
+@app.get("/search")
+async def search(q: str, password: str, owner: Optional[str] = None, limit: int = 20, offset: int = 0):
+    stored_password = os.environ.get("HTMLSHARE_PASSWORD")
+
+    if not stored_password:
+        raise ValueError("HTMLSHARE_PASSWORD environment variable not set")
+
+    if not hmac.compare_digest(password, stored_password):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if not SEARCH_ENABLED:
+        raise HTTPException(status_code=501, detail="Search is not available")
+
+    match = search_query(q)
+    if not match:
+        return {"results": []}
+
+    owner_filter = "AND owner=?" if owner is not None else ""
+    params = (match,) + ((owner,) if owner is not None else ()) + (min(max(limit, 1), SEARCH_MAX_RESULTS),
+                                                                 max(offset, 0))
+    # Title matches weigh more than body ones
+    rows = await readers.fetchall(
+        "SELECT html_records.id, html_search.title, snippet(html_search, 1, '', '', '…', 16) "
+        "FROM html_search JOIN html_records ON html_records.rowid=html_search.rowid "
+        f"WHERE html_search MATCH ? {owner_filter} "
+        "ORDER BY bm25(html_search, 5.0, 1.0, 0.0) LIMIT ? OFFSET ?", params)
+    return {"results": [{"id": row[0], "title": row[1], "snippet": row[2]} for row in rows]}
+
+# Moves bodies of existing rows which are above threshold to blob storage
+def migrate_large_rows(batch_size=100):
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    conn = connect()
+    conn.execute("PRAGMA busy_timeout=5000")
+    init_db(conn)
+    moved = 0
+    while True:
+        rows = conn.execute("SELECT id, html FROM html_records "
+                            "WHERE html IS NOT NULL AND length(CAST(html AS BLOB)) > ? LIMIT ?",
+                            (BLOB_THRESHOLD, batch_size)).fetchall()
+        if not rows:
+            break
+        with conn:
+            for record_id, html in rows:
+                name = write_blob(html.encode("utf-8"))
+                conn.execute("UPDATE html_records SET html=NULL, blob_path=? WHERE id=?", (name, record_id))
+        moved += len(rows)
+        print(f"Moved {moved} records to {BLOB_DIR}")
+    conn.close()
+    return moved
+
+
+print('App loaded')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="htmlshare maintenance tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate-blobs", help="Move large existing documents to blob storage")
+    migrate_parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == "migrate-blobs":
+        migrate_large_rows(args.batch_size)
\ No newline at end of file
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+from typing import Dict
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    # Limits how many updates are handled at once: per user and in total. Updates over the limit wait in bounded
+    # backlog, when it is full or update waited for too long it's rejected with Overloaded
+    def __init__(self, max_in_flight: int = 64, max_per_user: int = 4, max_backlog: int = 256,
+                 max_user_backlog: int = 32, max_wait: float = 30):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_backlog = max_backlog
+        # Single user shouldn't be able to fill the whole backlog and get others rejected
+        self.max_user_backlog = max_user_backlog
+        self.max_wait = max_wait
+        self.global_slots = asyncio.Semaphore(max_in_flight)
+        self.user_slots = {}  # type: Dict[int, asyncio.Semaphore]
+        # Updates of the user which are either waiting or in flight, used to drop semaphores nobody needs
+        self.user_refs = {}  # type: Dict[int, int]
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @classmethod
+    def from_env(cls) -> 'AdmissionController':
+        return cls(
+            max_in_flight=int(os.getenv('MAX_UPDATES_IN_FLIGHT', 64)),
+            max_per_user=int(os.getenv('MAX_UPDATES_PER_USER', 4)),
+            max_backlog=int(os.getenv('MAX_UPDATES_BACKLOG', 256)),
+        )
+
+    def _ref(self, user_id: int) -> asyncio.Semaphore:
+        self.user_refs[user_id] = self.user_refs.get(user_id, 0) + 1
+        if user_id not in self.user_slots:
+            self.user_slots[user_id] = asyncio.Semaphore(self.max_per_user)
+        return self.user_slots[user_id]
+
+    def _unref(self, user_id: int):
+        self.user_refs[user_id] -= 1
+        if self.user_refs[user_id] == 0:
+            del self.user_refs[user_id]
+            del self.user_slots[user_id]
+
+    async def _acquire(self, user_slots: asyncio.Semaphore):
+        # User slot first, so single user can't occupy whole global limit with waiting updates
+        await user_slots.acquire()
+        try:
+            await self.global_slots.acquire()
+        except BaseException:
+            user_slots.release()
+            raise
+
+    def _backlog_full(self, user_id: int) -> bool:
+        user_waiting = self.user_refs.get(user_id, 0) - self.max_per_user
+        return self.waiting >= self.max_backlog or user_waiting >= self.max_user_backlog
+
+    async def acquire(self, user_id: int):
+        user_slots = self.user_slots.get(user_id)
+        if (user_slots is None or not user_slots.locked()) and not self.global_slots.locked():
+            # Fast path, no waiting needed
+            await self._acquire(self._ref(user_id))
+        else:
+            if self._backlog_full(user_id):
+                self.rejected += 1
+                raise Overloaded()
+            user_slots = self._ref(user_id)
+            self.waiting += 1
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(self._acquire(user_slots), self.max_wait)
+            except asyncio.TimeoutError:
+                self._unref(user_id)
+                self.rejected += 1
+                raise Overloaded()
+            except BaseException:
+                self._unref(user_id)
+                raise
+            finally:
+                self.waiting -= 1
+            waited = time.monotonic() - started
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+        self.in_flight += 1
+        self.admitted += 1
+
+    def release(self, user_id: int):
+        self.in_flight -= 1
+        self.global_slots.release()
+        self.user_slots[user_id].release()
+        self._unref(user_id)
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'avg_wait': self.wait_time_total / self.admitted if self.admitted else 0.0,
+            'max_wait': self.wait_time_max,
+        }
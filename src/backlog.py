@@ -0,0 +1,143 @@
+import asyncio
+import itertools
+import os
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from aiogram import Bot
+from aiogram.bot import api
+
+from utils import get_logger
+
+logger = get_logger('bot')
+
+# Inline queries and callback buttons pressed while bot was down are useless by the time we get to them
+DRAINED_UPDATE_TYPES = ('message', 'edited_message', 'channel_post')
+
+
+def update_date(update: dict) -> Optional[int]:
+    for key in DRAINED_UPDATE_TYPES:
+        if key in update:
+            return update[key].get('date')
+    return None
+
+
+def is_stackable(update: dict) -> bool:
+    message = update.get('message') or {}
+    return 'forward_date' in message
+
+
+def group_stacks(updates: List[dict]) -> List[List[dict]]:
+    # Forwards of one user that arrived one after another are handed to bot together, otherwise rate limiting
+    # would space them more than StackForwardedMessagesMiddleware cooldown and split one post into many
+    groups = []
+    for update in updates:
+        previous = groups[-1][-1] if groups else None
+        if previous is not None and is_stackable(update) and is_stackable(previous) and \
+                update['message'].get('from', {}).get('id') == previous['message'].get('from', {}).get('id'):
+            groups[-1].append(update)
+        else:
+            groups.append([update])
+    return groups
+
+
+class BacklogDrainer:
+    # Processes updates which came while bot was down at limited rate, then hands over to normal polling
+    def __init__(self, bot: Bot, handle: Callable[[dict], Awaitable], rate: float = 10, max_age: float = 60 * 60,
+                 batch_size: int = 100):
+        self.bot = bot
+        self.handle = handle
+        self.rate = rate
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.total = 0
+        self.processed = 0
+        self.dropped = 0
+        self.running = False
+
+    @classmethod
+    def from_env(cls, bot: Bot, handle: Callable[[dict], Awaitable]) -> 'BacklogDrainer':
+        return cls(
+            bot, handle,
+            rate=float(os.getenv('BACKLOG_RATE', 10)),
+            max_age=float(os.getenv('BACKLOG_MAX_AGE', 60 * 60)),
+        )
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.processed - self.dropped)
+
+    def progress(self) -> str:
+        return f'{self.processed} processed, {self.dropped} dropped, {self.remaining} left'
+
+    def _is_fresh(self, update: dict, now: float) -> bool:
+        date = update_date(update)
+        return date is not None and now - date <= self.max_age
+
+    @staticmethod
+    def _is_new(update: dict, started: float) -> bool:
+        date = update_date(update)
+        return date is not None and date >= started
+
+    async def drain(self) -> Optional[int]:
+        # Returns offset polling should continue from
+        webhook = await self.bot.get_webhook_info()
+        if webhook.url:
+            await self.bot.delete_webhook()
+        if self.max_age <= 0:
+            # Catch-up disabled, behave like Dispatcher.skip_updates()
+            await self.bot.delete_webhook(drop_pending_updates=True)
+            return None
+
+        self.total = webhook.pending_update_count or 0
+        self.running = True
+        logger.info(f'Draining backlog of {self.total} updates')
+        # Messages sent after this moment are left to polling, otherwise busy bot would never leave drain loop
+        started = time.time()
+        offset = None
+        last_report = time.monotonic()
+        next_slot = time.monotonic()
+        # Stack at the end of a batch may continue in the next one
+        unfinished_stack = []
+        try:
+            while True:
+                # Raw params are sent as strings, so missing offset must be left out instead of becoming 'None'
+                params = {'limit': self.batch_size, 'timeout': 0}
+                if offset is not None:
+                    params['offset'] = offset
+                batch = await self.bot.request(api.Methods.GET_UPDATES, params)
+                updates = list(itertools.takewhile(lambda update: not self._is_new(update, started), batch))
+                caught_up = len(updates) < len(batch)
+                if updates:
+                    offset = updates[-1]['update_id'] + 1
+                    # Count updates which came after we asked for webhook info too
+                    self.total = max(self.total, self.processed + self.dropped + len(unfinished_stack) + len(updates))
+
+                now = time.time()
+                fresh = [update for update in updates if self._is_fresh(update, now)]
+                self.dropped += len(updates) - len(fresh)
+                groups = group_stacks(unfinished_stack + fresh)
+                last_batch = not batch or caught_up
+                unfinished_stack = groups.pop() if not last_batch and groups and is_stackable(groups[-1][-1]) else []
+                for group in groups:
+                    delay = next_slot - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    next_slot = max(next_slot, time.monotonic()) + 1 / self.rate
+                    for update in group:
+                        await self.handle(update)
+                    self.processed += len(group)
+
+                if caught_up:
+                    # Confirm drained updates, so polling starts right from the first new one
+                    offset = batch[len(updates)]['update_id']
+                    await self.bot.request(api.Methods.GET_UPDATES, {'offset': offset, 'limit': 1, 'timeout': 0})
+                if last_batch:
+                    break
+                if time.monotonic() - last_report > 5:
+                    last_report = time.monotonic()
+                    logger.info(f'Draining backlog: {self.progress()}')
+        finally:
+            self.running = False
+        logger.info(f'Backlog drained: {self.progress()}')
+        return offset
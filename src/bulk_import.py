@@ -0,0 +1,117 @@
+import asyncio
+import io
+import re
+import time
+from typing import BinaryIO, Awaitable, Callable, Iterable, Iterator, List, Optional
+
+from circuit_breaker import ServiceUnavailable
+from raindrop_api import RaindropApi
+from utils import get_logger, URL_REGEX
+
+logger = get_logger('bot')
+
+# Raindrop accepts up to 100 raindrops in one batch create request
+IMPORT_CHUNK_SIZE = 100
+# Raindrop allows 120 requests per minute, don't spend all of them on a single import
+IMPORT_CONCURRENCY = 3
+IMPORT_MAX_LINKS = 10000
+IMPORT_FILE_EXTENSIONS = ('.txt', '.csv', '.html', '.htm')
+
+HREF_REGEX = re.compile(r"""href\s*=\s*["'](https?://[^"']+)["']""", re.IGNORECASE)
+URL_REGEX_COMPILED = re.compile(URL_REGEX)
+
+ProgressCallback = Callable[[int, int, Optional[int]], Awaitable[None]]
+
+
+class ImportInterrupted(ServiceUnavailable):
+    # Service went down during import, chunks which weren't sent yet are skipped
+    def __init__(self, service: str, created: int):
+        super().__init__(service)
+        self.created = created
+
+
+def iter_links_from_lines(lines: Iterable[str], html: bool = False) -> Iterator[str]:
+    regex = HREF_REGEX if html else URL_REGEX_COMPILED
+    for line in lines:
+        for match in regex.finditer(line):
+            yield match.group(1) if html else match.group(0)
+
+
+def iter_links_from_file(file: BinaryIO, name: str) -> Iterator[str]:
+    # File is decoded and scanned line by line, so we never hold whole decoded text in memory. It should be real
+    # file on disk (not BytesIO), otherwise the raw file is in memory anyway
+    text = io.TextIOWrapper(file, encoding='utf-8', errors='replace', newline='')
+    try:
+        yield from iter_links_from_lines(text, html=name.lower().endswith(('.html', '.htm')))
+    finally:
+        # Caller owns the file. Otherwise wrapper closes it when garbage collected, possibly in executor thread
+        text.detach()
+
+
+def unique_links(links: Iterable[str], limit: int = IMPORT_MAX_LINKS) -> List[str]:
+    seen = set()
+    result = []
+    for link in links:
+        if link in seen:
+            continue
+        seen.add(link)
+        result.append(link)
+        if len(result) >= limit:
+            break
+    return result
+
+
+def is_importable_file(name: Optional[str]) -> bool:
+    return bool(name) and name.lower().endswith(IMPORT_FILE_EXTENSIONS)
+
+
+async def import_links(api: RaindropApi, links: List[str], on_progress: Optional[ProgressCallback] = None,
+                       concurrency: int = IMPORT_CONCURRENCY, collection_id: Optional[int] = None) -> int:
+    # Returns number of created raindrops. Chunk which failed is counted as not created, the rest are still imported.
+    # If Raindrop goes down, remaining chunks are skipped and ImportInterrupted is raised
+    chunks = [links[i:i + IMPORT_CHUNK_SIZE] for i in range(0, len(links), IMPORT_CHUNK_SIZE)]
+    semaphore = asyncio.Semaphore(concurrency)
+    processed = 0
+    created = 0
+    unavailable = None  # type: Optional[ServiceUnavailable]
+
+    async def import_chunk(chunk: List[str]):
+        nonlocal processed, created, unavailable
+        async with semaphore:
+            if unavailable is not None:
+                return
+            try:
+                created += await api.raindrops.create_many(chunk, collection_id=collection_id)
+            except ServiceUnavailable as e:
+                logger.warning(f'Import interrupted: {e}')
+                unavailable = e
+                return
+            except Exception:
+                logger.exception(f'Error while importing chunk of {len(chunk)} links')
+        processed += len(chunk)
+        if on_progress is not None:
+            await on_progress(processed, created, len(links))
+
+    await asyncio.gather(*[import_chunk(chunk) for chunk in chunks])
+    if unavailable is not None:
+        raise ImportInterrupted(unavailable.service, created)
+    return created
+
+
+def throttled_progress(callback: ProgressCallback, interval: float = 2) -> ProgressCallback:
+    # Telegram doesn't like when message is edited too often, so we report only latest progress once in a while
+    last_call = 0.0
+
+    async def wrapped(processed: int, created: int, total: Optional[int] = None):
+        nonlocal last_call
+        now = time.monotonic()
+        # Final progress is always reported. Export doesn't know total, so only intermediate ones are sent for it
+        if (total is None or processed < total) and now - last_call < interval:
+            return
+        last_call = now
+        try:
+            await callback(processed, created, total)
+        except Exception:
+            logger.exception('Error while reporting progress')
+
+    return wrapped
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import httpx
+
+from utils import get_logger
+
+logger = get_logger('bot')
+
+
+class ServiceUnavailable(Exception):
+    # External service is down: request timed out, failed with 5xx, or its circuit is open
+    def __init__(self, service: str):
+        super().__init__(f'{service} is unavailable')
+        self.service = service
+
+
+class CircuitOpen(ServiceUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, call_timeout: float = 10):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.call_timeout = call_timeout
+        self.failures = 0
+        self.opened_at = None  # type: Optional[float]
+        # In half-open state only one probe request is let through, the rest fail fast until we know its result
+        self.probe_in_flight = False
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, name: str, call_timeout: float) -> 'CircuitBreaker':
+        return cls(
+            name,
+            failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5)),
+            reset_timeout=float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30)),
+            call_timeout=float(os.getenv(f'{name.upper()}_TIMEOUT', call_timeout)),
+        )
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self.probe_in_flight):
+            self.rejected += 1
+            raise CircuitOpen(self.name)
+        if state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def on_success(self):
+        if self.opened_at is not None:
+            logger.info(f'{self.name} is available again, closing circuit')
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def on_failure(self):
+        self.failures += 1
+        if self.probe_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f'{self.name} failed {self.failures} times in a row, opening circuit')
+            self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+
+    def on_cancel(self):
+        # Call was cancelled by us, it says nothing about service health
+        self.probe_in_flight = False
+
+    async def call(self, func: Callable[..., Awaitable], *args, **kwargs):
+        self.before_call()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), self.call_timeout)
+        except asyncio.CancelledError:
+            self.on_cancel()
+            raise
+        except Exception as e:
+            self.on_failure()
+            raise ServiceUnavailable(self.name) from e
+        self.on_success()
+        return result
+
+    def stats(self) -> str:
+        return f'{self.name}: {self.state}, {self.failures} failures, {self.rejected} rejected'
+
+
+class BreakerTransport(httpx.AsyncBaseTransport):
+    # Puts all requests of httpx client behind circuit breaker. Connection errors, timeouts and 5xx are failures.
+    # Connection errors and timeouts are raised as ServiceUnavailable, same as open circuit, so callers handle
+    # outage with single except
+    def __init__(self, breaker: CircuitBreaker, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.breaker = breaker
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, method: bytes, url: Tuple[bytes, bytes, Optional[int], bytes],
+                                   headers: List[Tuple[bytes, bytes]], stream: httpx.AsyncByteStream,
+                                   extensions: dict) -> Tuple[int, List[Tuple[bytes, bytes]], httpx.AsyncByteStream,
+                                                              dict]:
+        # Transport API of httpx 0.19, see requirements.txt
+        self.breaker.before_call()
+        try:
+            status_code, headers, stream, extensions = await self.transport.handle_async_request(
+                method, url, headers, stream, extensions,
+            )
+        except httpx.TransportError as e:
+            self.breaker.on_failure()
+            raise ServiceUnavailable(self.breaker.name) from e
+        except BaseException:
+            self.breaker.on_cancel()
+            raise
+        if status_code >= 500:
+            self.breaker.on_failure()
+        else:
+            self.breaker.on_success()
+        return status_code, headers, stream, extensions
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+raindrop_breaker = CircuitBreaker.from_env('Raindrop', call_timeout=15)
+htmlshare_breaker = CircuitBreaker.from_env('Htmlshare', call_timeout=10)
+telegraph_breaker = CircuitBreaker.from_env('Telegraph', call_timeout=30)
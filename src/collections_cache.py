@@ -0,0 +1,127 @@
+import asyncio
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from raindrop_api import RaindropApi, Collection
+from utils import get_logger
+
+logger = get_logger('bot')
+
+
+class CollectionsTree:
+    def __init__(self, collections: List[Collection]):
+        self.collections = collections
+        self.by_id = {c.id: c for c in collections}
+        self.paths = {c.id: self._build_path(c) for c in collections}
+        # Sibling collections may have the same title. Their paths get id appended, so every path picked from
+        # keyboard points to exactly one collection
+        counts = Counter(self.paths.values())
+        for collection_id, path in self.paths.items():
+            if counts[path] > 1:
+                self.paths[collection_id] = f'{path} ({collection_id})'
+
+    def _build_path(self, collection: Collection) -> str:
+        parts = [collection.title]
+        parent_id = collection.parent_id
+        seen = {collection.id}
+        while parent_id is not None and parent_id in self.by_id and parent_id not in seen:
+            seen.add(parent_id)
+            parent = self.by_id[parent_id]
+            parts.append(parent.title)
+            parent_id = parent.parent_id
+        return ' / '.join(reversed(parts))
+
+    def options(self) -> List[Tuple[int, str]]:
+        return sorted(self.paths.items(), key=lambda item: item[1].lower())
+
+    def find_by_path(self, path: str) -> Optional[int]:
+        matches = [collection_id for collection_id, collection_path in self.paths.items() if collection_path == path]
+        return matches[0] if len(matches) == 1 else None
+
+
+class CollectionsCache:
+    # Per-user cache of collections tree. Stale trees are served immediately while fresh copy is fetched in
+    # background, so the tree is refetched at most once per refresh_after for each user
+    def __init__(self, max_users: int = 1000, refresh_after: float = 300, expire_after: float = 3600):
+        self.max_users = max_users
+        self.refresh_after = refresh_after
+        self.expire_after = expire_after
+        self.entries = OrderedDict()  # type: OrderedDict[int, Tuple[float, CollectionsTree]]
+        self.pending = {}  # type: Dict[int, asyncio.Task]
+
+    @classmethod
+    def from_env(cls) -> 'CollectionsCache':
+        return cls(
+            max_users=int(os.getenv('COLLECTIONS_CACHE_USERS', 1000)),
+            refresh_after=float(os.getenv('COLLECTIONS_CACHE_REFRESH', 300)),
+        )
+
+    def _get_entry(self, user_id: int) -> Optional[Tuple[float, CollectionsTree]]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.expire_after:
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return entry
+
+    def _store(self, user_id: int, tree: CollectionsTree):
+        self.entries[user_id] = (time.monotonic(), tree)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_users:
+            self.entries.popitem(last=False)
+
+    def _refresh(self, user_id: int, api: RaindropApi) -> asyncio.Task:
+        task = self.pending.get(user_id)
+        if task is not None:
+            return task
+
+        async def run() -> Optional[CollectionsTree]:
+            tree = CollectionsTree(await api.collections.get_all())
+            # Refresh dropped by invalidate() was fetched with old API key, its tree may be of another account
+            if self.pending.get(user_id) is not task:
+                return None
+            self._store(user_id, tree)
+            return tree
+
+        def done(finished: asyncio.Task):
+            if self.pending.get(user_id) is finished:
+                del self.pending[user_id]
+
+        task = asyncio.create_task(run())
+        task.add_done_callback(done)
+        task.add_done_callback(self._log_failure)
+        self.pending[user_id] = task
+        return task
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f'Error while fetching collections: {task.exception()!r}')
+
+    def peek(self, user_id: int, api: RaindropApi) -> Optional[CollectionsTree]:
+        # Never waits for network, missing or stale tree is fetched in background
+        entry = self._get_entry(user_id)
+        if entry is None or time.monotonic() - entry[0] > self.refresh_after:
+            self._refresh(user_id, api)
+        return entry[1] if entry is not None else None
+
+    async def get(self, user_id: int, api: RaindropApi) -> Optional[CollectionsTree]:
+        entry = self._get_entry(user_id)
+        if entry is not None:
+            if time.monotonic() - entry[0] > self.refresh_after:
+                self._refresh(user_id, api)
+            return entry[1]
+
+        try:
+            return await asyncio.shield(self._refresh(user_id, api))
+        except Exception:
+            return None
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+        # Refresh which is already running won't store its result, next call starts a new one
+        self.pending.pop(user_id, None)
@@ -1,10 +1,10 @@
 import os
 import asyncio
-from pymongo import IndexModel, ASCENDING
+from pymongo import IndexModel, ASCENDING, ReturnDocument
 from motor import motor_asyncio
 from aiogram.contrib.fsm_storage import mongo as mongo_fsm
 
-from typing import List, Type, TypeVar, Optional
+from typing import Dict, List, Type, TypeVar, Optional
 from motor import motor_asyncio
 from datetime import datetime
 import pydantic
@@ -97,6 +97,7 @@ class User(MongoModel):
     telegram_id: int = Field()
     raindrop_api_key: Optional[str] = Field(None)
     last_used: Optional[datetime] = Field(None)
+    default_collection_id: Optional[int] = Field(None)
 
     @classmethod
     @property
@@ -121,6 +122,40 @@ class User(MongoModel):
         return user
 
 
+class HtmlshareMigration(MongoModel):
+    # Checkpoint of moving user's posts from old htmlshare instance, lets interrupted migration resume
+    id: OID = Field()
+    telegram_id: int = Field()
+    source_base: str = Field()
+    # Old document id -> URL of its copy, so documents aren't copied again if raindrop update failed
+    copied: Dict[str, str] = Field(default_factory=dict)
+    migrated: int = Field(0)
+    failed: int = Field(0)
+    finished_at: Optional[datetime] = Field(None)
+
+    @classmethod
+    @property
+    def collection(cls):
+        return 'HtmlshareMigration'
+
+    @classmethod
+    @property
+    def indexes(cls):
+        return [
+            IndexModel([('telegram_id', ASCENDING), ('source_base', ASCENDING)], name="telegram_id_source_base",
+                       unique=True),
+        ]
+
+    @classmethod
+    async def get_or_create(cls, db, telegram_id: int, source_base: str) -> 'HtmlshareMigration':
+        data = await db[cls.collection].find_one_and_update(
+            {'telegram_id': telegram_id, 'source_base': source_base},
+            {'$setOnInsert': {'copied': {}, 'migrated': 0, 'failed': 0}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return cls.from_mongo(data)
+
+
 MONGO_HOST = os.getenv('MONGO_HOST')
 MONGO_PORT = int(os.getenv('MONGO_PORT'))
 MONGO_USER = os.getenv('MONGO_INITDB_ROOT_USERNAME')
@@ -0,0 +1,157 @@
+import asyncio
+import csv
+import gzip
+import html
+import io
+import json
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, List, Optional
+
+from raindrop_api import RaindropApi, RaindropLite, SortOrder
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'html')
+EXPORT_PAGE_SIZE = 50
+EXPORT_CONCURRENCY = 3
+
+# (exported, pages)
+ProgressCallback = Callable[[int, int], Awaitable]
+
+
+async def iter_raindrop_pages(api: RaindropApi, concurrency: int = EXPORT_CONCURRENCY,
+                              per_page: int = EXPORT_PAGE_SIZE) -> AsyncIterator[List[RaindropLite]]:
+    # Pages are yielded in order, but next ones are already requested while current one is being written.
+    # Oldest first, so raindrops saved during export don't shift pages we haven't read yet
+    def request(page: int) -> asyncio.Task:
+        return asyncio.create_task(api.raindrops.get(sort=SortOrder.created_asc, page=page, per_page=per_page,
+                                                     retries=3))
+
+    in_flight = [request(page) for page in range(concurrency)]
+    next_page = concurrency
+    try:
+        while in_flight:
+            drops = await in_flight.pop(0)
+            if drops:
+                yield drops
+            if len(drops) < per_page:
+                break
+            in_flight.append(request(next_page))
+            next_page += 1
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+def _created_timestamp(drop: RaindropLite) -> int:
+    created = drop.raw.get('created')
+    if not created:
+        return 0
+    try:
+        return int(datetime.fromisoformat(created.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return 0
+
+
+def _collection_id(drop: RaindropLite) -> Optional[int]:
+    return (drop.raw.get('collection') or {}).get('$id')
+
+
+class _CsvWriter:
+    FIELDS = ('id', 'title', 'link', 'excerpt', 'tags', 'created', 'collection_id')
+
+    def __init__(self, stream: io.TextIOBase):
+        self.writer = csv.writer(stream)
+
+    def header(self):
+        self.writer.writerow(self.FIELDS)
+
+    def write(self, drops: List[RaindropLite]):
+        self.writer.writerows(
+            (drop.id, drop.title, drop.link, drop.description, ','.join(drop.raw.get('tags') or []),
+             drop.raw.get('created', ''), _collection_id(drop))
+            for drop in drops
+        )
+
+    def footer(self):
+        pass
+
+
+class _JsonlWriter:
+    def __init__(self, stream: io.TextIOBase):
+        self.stream = stream
+
+    def header(self):
+        pass
+
+    def write(self, drops: List[RaindropLite]):
+        # Raw API items, so nothing is lost
+        self.stream.writelines(json.dumps(drop.raw, ensure_ascii=False) + '\n' for drop in drops)
+
+    def footer(self):
+        pass
+
+
+class _NetscapeWriter:
+    # Format every browser and bookmark manager (Raindrop included) can import
+    def __init__(self, stream: io.TextIOBase):
+        self.stream = stream
+
+    def header(self):
+        self.stream.write('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+                          '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+                          '<TITLE>Raindrop bookmarks</TITLE>\n'
+                          '<H1>Raindrop bookmarks</H1>\n'
+                          '<DL><p>\n')
+
+    def write(self, drops: List[RaindropLite]):
+        for drop in drops:
+            tags = html.escape(','.join(drop.raw.get('tags') or []))
+            self.stream.write(f'    <DT><A HREF="{html.escape(drop.link)}" ADD_DATE="{_created_timestamp(drop)}" '
+                              f'TAGS="{tags}">{html.escape(drop.title or drop.link)}</A>\n')
+            if drop.description:
+                self.stream.write(f'    <DD>{html.escape(drop.description)}\n')
+
+    def footer(self):
+        self.stream.write('</DL><p>\n')
+
+
+WRITERS = {
+    'csv': _CsvWriter,
+    'jsonl': _JsonlWriter,
+    'html': _NetscapeWriter,
+}
+
+
+def export_filename(export_format: str, compress: bool) -> str:
+    name = f'raindrops-{datetime.utcnow():%Y-%m-%d}.{export_format}'
+    return name + '.gz' if compress else name
+
+
+async def export_raindrops(api: RaindropApi, export_format: str = 'csv', compress: bool = False,
+                           on_progress: Optional[ProgressCallback] = None) -> BinaryIO:
+    # Returns file positioned at the start, caller must close it. Only a few pages are held in memory at once,
+    # the rest goes to disk. Not SpooledTemporaryFile: aiogram's InputFile accepts it only on Python 3.11+
+    result = tempfile.TemporaryFile()
+    binary = gzip.GzipFile(fileobj=result, mode='wb') if compress else result
+    stream = io.TextIOWrapper(binary, encoding='utf-8', newline='', write_through=True)
+    writer = WRITERS[export_format](stream)
+    exported = pages = 0
+    try:
+        writer.header()
+        async for drops in iter_raindrop_pages(api):
+            writer.write(drops)
+            exported += len(drops)
+            pages += 1
+            if on_progress is not None:
+                await on_progress(exported, pages)
+        writer.footer()
+        stream.flush()
+        # Detached wrapper won't close the file under it when garbage collected, gzip is closed to write its trailer
+        stream.detach()
+        if compress:
+            binary.close()
+    except BaseException:
+        result.close()
+        raise
+    result.seek(0)
+    return result
@@ -8,3 +8,8 @@ class ConfigFlow(StatesGroup):
 class SettingsFlow(StatesGroup):
     waiting_for_setting_select = State()
     waiting_for_new_key = State()
+    waiting_for_collection = State()
+
+
+class ImportFlow(StatesGroup):
+    waiting_for_links = State()
@@ -1,6 +1,10 @@
+import asyncio
 import os
-from httpx import AsyncClient
+from typing import List, NamedTuple, Optional
 
+from httpx import AsyncClient, Response
+
+from circuit_breaker import BreakerTransport, ServiceUnavailable, htmlshare_breaker
 from utils import get_logger
 
 
@@ -11,9 +15,61 @@ logger = get_logger('bot')
 
 logger.info(f"Using {HTMLSHARE_ROOT_URL} as htmlshare domain")
 
-async def upload_html(html: str):
-    async with AsyncClient() as client:
-        response = await client.post(f'{HTMLSHARE_ROOT_URL}/html', json={"html": html, "password": HTMLSHARE_PASSWORD})
+
+def rate_limit_delay(response: Response, attempt: int) -> float:
+    # htmlshare counts requests in sliding 60 seconds window and doesn't say when it frees up
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return min(int(retry_after), 60)
+    return min(10 * 2 ** attempt, 60)
+
+
+class HtmlSearchHit(NamedTuple):
+    id: str
+    title: str
+    snippet: str
+
+    @property
+    def link(self) -> str:
+        return f'{HTMLSHARE_ROOT_URL}/html/{self.id}'
+
+
+async def upload_html(html: str, title: Optional[str] = None, owner: Optional[int] = None,
+                      retries: int = 0) -> Optional[str]:
+    # Raises ServiceUnavailable if htmlshare is down, returns None if it refused to store the document.
+    # Title and owner are used only by search
+    async with AsyncClient(timeout=htmlshare_breaker.call_timeout,
+                           transport=BreakerTransport(htmlshare_breaker)) as client:
+        for attempt in range(retries + 1):
+            # Password in header lets request skip htmlshare's per-IP rate limit
+            response = await client.post(f'{HTMLSHARE_ROOT_URL}/html', json={
+                "html": html, "password": HTMLSHARE_PASSWORD, "title": title,
+                "owner": str(owner) if owner is not None else None,
+            }, headers={"X-Htmlshare-Password": HTMLSHARE_PASSWORD})
+            if response.status_code == 429 and attempt < retries:
+                delay = rate_limit_delay(response, attempt)
+                logger.warning(f'htmlshare rate limit hit, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            break
+        if response.status_code >= 500:
+            raise ServiceUnavailable(htmlshare_breaker.name)
         if response.status_code != 200:
             return None
-        return f'{HTMLSHARE_ROOT_URL}/html/{response.json()["id"]}'
\ No newline at end of file
+        return f'{HTMLSHARE_ROOT_URL}/html/{response.json()["id"]}'
+
+
+async def search_html(query: str, owner: int, page: int = 0, per_page: int = 20) -> List[HtmlSearchHit]:
+    # Searches text of posts saved by user, empty list if htmlshare doesn't support search
+    async with AsyncClient(timeout=htmlshare_breaker.call_timeout,
+                           transport=BreakerTransport(htmlshare_breaker)) as client:
+        response = await client.get(f'{HTMLSHARE_ROOT_URL}/search', params={
+            "q": query, "password": HTMLSHARE_PASSWORD, "owner": str(owner),
+            "limit": per_page, "offset": page * per_page,
+        })
+        if response.status_code >= 500 and response.status_code != 501:
+            raise ServiceUnavailable(htmlshare_breaker.name)
+        if response.status_code != 200:
+            logger.warning('htmlshare search failed with status %s', response.status_code)
+            return []
+        return [HtmlSearchHit(**hit) for hit in response.json()['results']]
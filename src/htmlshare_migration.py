@@ -0,0 +1,164 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+from motor import motor_asyncio
+
+from db import HtmlshareMigration
+from htmlshare_api import HTMLSHARE_ROOT_URL, rate_limit_delay, upload_html
+from raindrop_api import RaindropApi, RaindropLite
+from utils import get_logger
+
+logger = get_logger('bot')
+
+# Posts saved by bot before htmlshare was moved
+HTMLSHARE_OLD_BASE_URL = os.getenv('HTMLSHARE_OLD_BASE_URL', 'https://raindropio-html-share.sinja.io')
+MIGRATION_PAGE_SIZE = 50
+MIGRATION_BATCH_SIZE = 20
+# Raindrop allows 120 requests per minute, so there is no point in going much faster
+MIGRATION_CONCURRENCY = 3
+# htmlshare allows 30 requests per minute from one IP and every copy costs a request on both servers. Copies are
+# spaced below that limit, so the rest of the budget is left to posts users save meanwhile
+MIGRATION_COPY_INTERVAL = float(os.getenv('HTMLSHARE_MIGRATION_INTERVAL', 2.5))
+MIGRATION_COPY_RETRIES = 5
+
+# (processed, migrated, total)
+ProgressCallback = Callable[[int, int, int], Awaitable]
+
+
+def htmlshare_document_id(link: str, base: str) -> Optional[str]:
+    prefix = f'{base.rstrip("/")}/html/'
+    if not link.startswith(prefix):
+        return None
+    return link[len(prefix):].split('?')[0].split('#')[0] or None
+
+
+def migration_available() -> bool:
+    return HTMLSHARE_OLD_BASE_URL.rstrip('/') != HTMLSHARE_ROOT_URL.rstrip('/')
+
+
+async def find_hosted_raindrops(api: RaindropApi, base: str,
+                                concurrency: int = MIGRATION_CONCURRENCY) -> List[RaindropLite]:
+    # All pages are collected before anything is changed: migrated raindrops stop matching search, so paging
+    # while updating them would skip some
+    host = urlsplit(base).hostname or base
+    found = {}  # type: Dict[int, RaindropLite]
+    page = 0
+    while True:
+        pages = await asyncio.gather(*[
+            api.raindrops.get(search=host, page=page + i, per_page=MIGRATION_PAGE_SIZE, retries=3)
+            for i in range(concurrency)
+        ])
+        for drops in pages:
+            for drop in drops:
+                if htmlshare_document_id(drop.link, base) is not None:
+                    found[drop.id] = drop
+        if any(len(drops) < MIGRATION_PAGE_SIZE for drops in pages):
+            break
+        page += concurrency
+    return list(found.values())
+
+
+class CopyPacer:
+    # Shared by all running migrations, they all come to htmlshare from the same IP
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+copy_pacer = CopyPacer(MIGRATION_COPY_INTERVAL)
+
+
+class HtmlshareMigrationJob:
+    # Copies user's posts from old htmlshare instance to current one and points raindrops to copies.
+    # Progress is saved after every batch, running job again continues where it stopped
+    def __init__(self, db: motor_asyncio.AsyncIOMotorDatabase, telegram_id: int, api: RaindropApi,
+                 source_base: str = HTMLSHARE_OLD_BASE_URL, on_progress: Optional[ProgressCallback] = None,
+                 concurrency: int = MIGRATION_CONCURRENCY, batch_size: int = MIGRATION_BATCH_SIZE):
+        self.db = db
+        self.telegram_id = telegram_id
+        self.api = api
+        self.source_base = source_base.rstrip('/')
+        self.on_progress = on_progress
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    async def _copy_document(self, client: httpx.AsyncClient, document_id: str) -> Optional[str]:
+        for attempt in range(MIGRATION_COPY_RETRIES + 1):
+            await copy_pacer.wait()
+            response = await client.get(f'{self.source_base}/html/{document_id}')
+            if response.status_code == 429 and attempt < MIGRATION_COPY_RETRIES:
+                delay = rate_limit_delay(response, attempt)
+                logger.warning(f'{self.source_base} rate limit hit, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            break
+        if response.status_code == 404:
+            logger.warning(f'Document {document_id} is already gone from {self.source_base}')
+            return None
+        response.raise_for_status()
+        return await upload_html(response.text, owner=self.telegram_id, retries=MIGRATION_COPY_RETRIES)
+
+    async def _migrate_one(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, drop: RaindropLite,
+                           copied: Dict[str, str]) -> Tuple[Optional[str], Optional[str], bool]:
+        document_id = htmlshare_document_id(drop.link, self.source_base)
+        async with semaphore:
+            new_url = copied.get(document_id)
+            try:
+                if new_url is None:
+                    new_url = await self._copy_document(client, document_id)
+                if new_url is None:
+                    return document_id, None, False
+                return document_id, new_url, await self.api.raindrops.update_link(drop.id, new_url)
+            except Exception:
+                logger.exception(f'Error while migrating raindrop {drop.id}')
+                return document_id, new_url, False
+
+    async def _save_checkpoint(self, results: List[Tuple[Optional[str], Optional[str], bool]]):
+        update = {'$inc': {
+            'migrated': sum(1 for _, _, ok in results if ok),
+            'failed': sum(1 for _, _, ok in results if not ok),
+        }}
+        new_copies = {f'copied.{document_id}': url for document_id, url, ok in results if url and not ok}
+        if new_copies:
+            update['$set'] = new_copies
+        await self.db[HtmlshareMigration.collection].update_one(
+            {'telegram_id': self.telegram_id, 'source_base': self.source_base}, update,
+        )
+
+    async def run(self) -> Tuple[int, int]:
+        # Returns number of found and migrated raindrops
+        checkpoint = await HtmlshareMigration.get_or_create(self.db, self.telegram_id, self.source_base)
+        drops = await find_hosted_raindrops(self.api, self.source_base, self.concurrency)
+        logger.info(f'Migrating {len(drops)} htmlshare posts of user {self.telegram_id}')
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        processed = migrated = 0
+        async with httpx.AsyncClient(timeout=30) as client:
+            for start in range(0, len(drops), self.batch_size):
+                batch = drops[start:start + self.batch_size]
+                results = await asyncio.gather(*[
+                    self._migrate_one(client, semaphore, drop, checkpoint.copied) for drop in batch
+                ])
+                await self._save_checkpoint(results)
+                processed += len(batch)
+                migrated += sum(1 for _, _, ok in results if ok)
+                if self.on_progress is not None:
+                    await self.on_progress(processed, migrated, len(drops))
+
+        await self.db[HtmlshareMigration.collection].update_one(
+            {'telegram_id': self.telegram_id, 'source_base': self.source_base},
+            {'$set': {'finished_at': datetime.utcnow()}},
+        )
+        return len(drops), migrated
@@ -0,0 +1,119 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, List, Optional
+
+from aiogram import types as tgtypes
+
+from utils import get_logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = get_logger('bot')
+
+# <main> in misc/post_template.html is at most 800px wide with 16px padding on both sides
+READING_MODE_WIDTH = 768
+
+
+def pick_photo_size(sizes: List[tgtypes.PhotoSize], target_width: int) -> tgtypes.PhotoSize:
+    # Smallest size which still fills reading mode column, or the biggest one if all of them are smaller
+    ordered = sorted(sizes, key=lambda x: x.width)
+    for size in ordered:
+        if size.width >= target_width:
+            return size
+    return ordered[-1]
+
+
+def recompress_jpeg(data: bytes, max_width: int, quality: int) -> bytes:
+    # Runs in worker process, so it must stay top-level function
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if image.width > max_width:
+            height = round(image.height * max_width / image.width)
+            image = image.resize((max_width, height), Image.LANCZOS)
+        result = io.BytesIO()
+        image.save(result, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return result.getvalue()
+
+
+class ImagePreparer:
+    def __init__(self, enabled: bool = False, pixel_ratio: float = 1.5, quality: int = 82,
+                 recompress_above: int = 200 * 1024, workers: int = 2):
+        self.enabled = enabled
+        self.target_width = int(READING_MODE_WIDTH * pixel_ratio)
+        self.quality = quality
+        self.recompress_above = recompress_above
+        self.workers = workers
+        self.pool = None  # type: Optional[ProcessPoolExecutor]
+        self.images_processed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        # Difference between the biggest photo size and the one we picked
+        self.bytes_skipped = 0
+
+        if self.enabled and Image is None:
+            logger.warning('Pillow is not installed, images will be only resized by picking smaller photo size')
+
+    @classmethod
+    def from_env(cls) -> 'ImagePreparer':
+        return cls(
+            enabled=os.getenv('PREPARE_IMAGES', 'false') == 'true',
+            pixel_ratio=float(os.getenv('IMAGE_PIXEL_RATIO', 1.5)),
+            quality=int(os.getenv('IMAGE_QUALITY', 82)),
+            workers=int(os.getenv('IMAGE_WORKERS', min(2, os.cpu_count() or 1))),
+        )
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_before - self.bytes_after + self.bytes_skipped
+
+    def pick(self, sizes: List[tgtypes.PhotoSize]) -> tgtypes.PhotoSize:
+        biggest = sorted(sizes, key=lambda x: x.width, reverse=True)[0]
+        if not self.enabled:
+            return biggest
+        picked = pick_photo_size(sizes, self.target_width)
+        if biggest.file_size and picked.file_size:
+            self.bytes_skipped += biggest.file_size - picked.file_size
+        return picked
+
+    def _needs_recompression(self, size: tgtypes.PhotoSize) -> bool:
+        return size.width > self.target_width * 1.25 or (size.file_size or 0) > self.recompress_above
+
+    async def prepare(self, file: BinaryIO, size: tgtypes.PhotoSize) -> BinaryIO:
+        # Returns either the same file or new one with smaller image. Caller is responsible for closing both
+        if not self.enabled or Image is None or not self._needs_recompression(size):
+            return file
+
+        if self.pool is None:
+            # Forking bot process would copy locks held by motor's, logging and profiler threads into workers
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        data = file.read()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.pool, recompress_jpeg, data, self.target_width, self.quality
+            )
+        except Exception:
+            logger.exception('Error while recompressing image, uploading original')
+            file.seek(0)
+            return file
+
+        if len(result) >= len(data):
+            result = data
+
+        self.images_processed += 1
+        self.bytes_before += len(data)
+        self.bytes_after += len(result)
+        logger.info(f'Image prepared: {len(data)} -> {len(result)} bytes')
+        return io.BytesIO(result)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
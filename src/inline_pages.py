@@ -0,0 +1,170 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from raindrop_api import RaindropLite
+from utils import get_logger
+
+logger = get_logger('bot')
+
+PageKey = Tuple[int, str, int]
+PageFetcher = Callable[[], Awaitable[List[RaindropLite]]]
+
+
+class InlinePagesCache:
+    # Keeps recently fetched (and prefetched) pages of inline search results, so when user scrolls inline results
+    # next page is answered from memory. Prefetching is limited by per-user budget, so it can't amplify API load
+    def __init__(self, ttl: float = 60, max_pages: int = 2000, prefetch_budget: int = 10,
+                 prefetch_window: float = 60):
+        self.ttl = ttl
+        self.max_pages = max_pages
+        self.prefetch_budget = prefetch_budget
+        self.prefetch_window = prefetch_window
+        self.pages = OrderedDict()  # type: OrderedDict[PageKey, Tuple[float, List[RaindropLite]]]
+        self.pending = {}  # type: Dict[PageKey, asyncio.Task]
+        self.background = set()  # type: Set[PageKey]
+        self.waiters = {}  # type: Dict[PageKey, int]
+        self.prefetches = {}  # type: Dict[int, deque]
+
+    @classmethod
+    def from_env(cls) -> 'InlinePagesCache':
+        return cls(
+            ttl=float(os.getenv('INLINE_PAGES_TTL', 60)),
+            max_pages=int(os.getenv('INLINE_PAGES_MAX', 2000)),
+            prefetch_budget=int(os.getenv('INLINE_PREFETCH_BUDGET', 10)),
+        )
+
+    def _get_cached(self, key: PageKey) -> Optional[List[RaindropLite]]:
+        entry = self.pages.get(key)
+        if entry is None:
+            return None
+        stored_at, drops = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self.pages[key]
+            return None
+        self.pages.move_to_end(key)
+        return drops
+
+    def _store(self, key: PageKey, drops: List[RaindropLite]):
+        self.pages[key] = (time.monotonic(), drops)
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+
+    def is_cached(self, key: PageKey) -> bool:
+        return self._get_cached(key) is not None
+
+    def _spawn(self, key: PageKey, fetcher: PageFetcher, background: bool) -> asyncio.Task:
+        async def run():
+            try:
+                drops = await fetcher()
+                self._store(key, drops)
+                return drops
+            except Exception:
+                if background:
+                    logger.exception('Error while prefetching inline results page')
+                raise
+            finally:
+                if self.pending.get(key) is asyncio.current_task():
+                    del self.pending[key]
+                self.background.discard(key)
+
+        task = asyncio.create_task(run())
+        # Prevents 'exception was never retrieved' warning when nobody awaits failed fetch
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self.pending[key] = task
+        if background:
+            self.background.add(key)
+        return task
+
+    async def get(self, key: PageKey, fetcher: PageFetcher) -> List[RaindropLite]:
+        drops = self._get_cached(key)
+        if drops is not None:
+            return drops
+
+        task = self.pending.get(key)
+        if task is not None and key in self.background:
+            # Page is being prefetched right now, no need to request it once more
+            try:
+                return await asyncio.shield(task)
+            except Exception:
+                logger.warning(f'Prefetch of {key} failed, fetching it again')
+                task = None
+
+        if task is None:
+            task = self._spawn(key, fetcher, background=False)
+
+        # Identical concurrent queries share single upstream request. It's cancelled only when nobody waits for it
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+                if not task.done():
+                    task.cancel()
+
+    def _take_prefetch_budget(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if len(self.prefetches) > self.max_pages:
+            self.prefetches = {uid: h for uid, h in self.prefetches.items()
+                               if h and now - h[-1] <= self.prefetch_window}
+        history = self.prefetches.setdefault(user_id, deque())
+        while history and now - history[0] > self.prefetch_window:
+            history.popleft()
+        if len(history) >= self.prefetch_budget:
+            return False
+        history.append(now)
+        return True
+
+    def prefetch(self, key: PageKey, fetcher: PageFetcher):
+        if key in self.pending or self._get_cached(key) is not None:
+            return
+
+        user_id = key[0]
+        if not self._take_prefetch_budget(user_id):
+            logger.debug('Prefetch budget exhausted for user %s', user_id)
+            return
+
+        self._spawn(key, fetcher, background=True)
+
+
+class QuerySuperseded(Exception):
+    pass
+
+
+class LatestQueryRunner:
+    # Runs only the newest search per user. When newer query from the same user arrives, previous one is cancelled
+    # (if still in debounce window, it won't even reach Raindrop API)
+    def __init__(self, debounce: float = 0.3):
+        self.debounce = debounce
+        self.current = {}  # type: Dict[int, asyncio.Task]
+
+    @classmethod
+    def from_env(cls) -> 'LatestQueryRunner':
+        return cls(debounce=float(os.getenv('INLINE_DEBOUNCE', 0.3)))
+
+    async def run(self, user_id: int, func: PageFetcher) -> List[RaindropLite]:
+        previous = self.current.get(user_id)
+        if previous is not None and not previous.done():
+            previous.cancel()
+
+        async def job():
+            if self.debounce:
+                await asyncio.sleep(self.debounce)
+            return await func()
+
+        task = asyncio.create_task(job())
+        self.current[user_id] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self.current.get(user_id) is not task:
+                raise QuerySuperseded()
+            raise
+        finally:
+            if self.current.get(user_id) is task:
+                del self.current[user_id]
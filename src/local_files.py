@@ -0,0 +1,225 @@
+import asyncio
+import io
+import mmap
+import os
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Dict, Optional
+
+from aiogram import Bot
+
+from utils import get_logger, RUN_IN_DOCKER
+
+logger = get_logger('bot')
+
+
+def to_local_path(server_path: str) -> str:
+    # Bot API server and bot see the shared volume under different paths, see docker-compose.yml
+    if RUN_IN_DOCKER:
+        return server_path.replace('/srv/', '/raindropiobot/', 1)
+    return server_path.replace('/srv/public/', './bot_server_volume/', 1)
+
+
+class LocalFile(io.BufferedReader):
+    def __init__(self, path: str, on_close: Callable[[str], None]):
+        super().__init__(io.FileIO(path, 'rb'))
+        self.on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.on_close(self.name)
+
+
+class MappedFile(io.RawIOBase):
+    # File mapped into memory, read() returns slices of the mapping instead of copying data into new bytes.
+    # Pages come straight from page cache, so uploading big attachment costs no extra memory
+    def __init__(self, path: str, on_close: Callable[[str], None]):
+        super().__init__()
+        self.name = path
+        self.on_close = on_close
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # Empty file can't be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self.map) if size else memoryview(b'')
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def read(self, size: Optional[int] = -1) -> memoryview:
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        chunk = self.view[self.position:end]
+        self.position = max(self.position, end)
+        return chunk
+
+    def readall(self) -> memoryview:
+        return self.read()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Somebody still holds a chunk, mapping is unmapped when it's garbage collected
+                logger.debug('Mapping of %s is still in use', self.name)
+        self.file.close()
+        self.on_close(self.name)
+
+
+class LocalBotFiles:
+    # With self-hosted Bot API server attachments are downloaded into volume shared with bot and read right from it.
+    # getFile results are cached, files bot is done with are deleted after `keep` seconds, so volume doesn't fill up
+    def __init__(self, bot: Bot, max_size: int = 1024, keep: float = 10 * 60, cleanup: bool = True,
+                 cleanup_interval: float = 60):
+        self.bot = bot
+        self.max_size = max_size
+        self.keep = keep
+        self.cleanup = cleanup
+        self.cleanup_interval = cleanup_interval
+        self.paths = OrderedDict()  # type: OrderedDict[str, str]
+        self.pending = {}  # type: Dict[str, asyncio.Future]
+        self.in_use = {}  # type: Dict[str, int]
+        # Path -> when it was closed for the last time
+        self.finished = {}  # type: Dict[str, float]
+        self.task = None  # type: Optional[asyncio.Task]
+        self.loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self.lookups = 0
+        self.hits = 0
+        self.removed = 0
+        self.removed_bytes = 0
+
+    @classmethod
+    def from_env(cls, bot: Bot) -> 'LocalBotFiles':
+        return cls(
+            bot,
+            keep=float(os.getenv('LOCAL_FILES_KEEP', 10 * 60)),
+            cleanup=os.getenv('LOCAL_FILES_CLEANUP', 'true') == 'true',
+        )
+
+    async def _resolve(self, file_id: str) -> str:
+        attachment_info = await self.bot.get_file(file_id)
+        return to_local_path(attachment_info.file_path)
+
+    async def path(self, file_id: str) -> str:
+        self.lookups += 1
+        path = self.paths.get(file_id)
+        # File might be removed by server or by us, then server downloads it again on getFile
+        if path is not None and os.path.exists(path):
+            self.hits += 1
+            self.paths.move_to_end(file_id)
+            return path
+
+        if file_id in self.pending:
+            return await asyncio.shield(self.pending[file_id])
+
+        future = asyncio.ensure_future(self._resolve(file_id))
+        self.pending[file_id] = future
+        try:
+            path = await asyncio.shield(future)
+        finally:
+            if self.pending.get(file_id) is future:
+                del self.pending[file_id]
+        self.paths[file_id] = path
+        self.paths.move_to_end(file_id)
+        while len(self.paths) > self.max_size:
+            self.paths.popitem(last=False)
+        return path
+
+    async def open(self, file_id: str, mapped: bool = False) -> BinaryIO:
+        # Mapped files are for uploads with httpx, which pass chunks through as they are. Things which need real
+        # bytes (Pillow, aiohttp, text decoding) get regular buffered file
+        path = await self.path(file_id)
+        self.loop = asyncio.get_running_loop()
+        file = MappedFile(path, self._closed) if mapped else LocalFile(path, self._closed)
+        self.in_use[path] = self.in_use.get(path, 0) + 1
+        self.finished.pop(path, None)
+        return file
+
+    def _closed(self, path: str):
+        # Files are also closed in executor threads (e.g. after parsing import), bookkeeping is done on the loop
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            self._release(path)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._release, path)
+        except RuntimeError:
+            # Loop is already closed, bot is shutting down
+            pass
+
+    def _release(self, path: str):
+        count = self.in_use.get(path, 1) - 1
+        if count > 0:
+            self.in_use[path] = count
+            return
+        self.in_use.pop(path, None)
+        if not self.cleanup:
+            return
+        if self.keep <= 0:
+            self._remove(path)
+            return
+        self.finished[path] = time.monotonic()
+        if self.task is None or self.task.done():
+            self.task = self.loop.create_task(self._cleanup_loop())
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        except OSError:
+            logger.exception(f'Error while removing {path}')
+            return
+        self.removed += 1
+        self.removed_bytes += size
+        for file_id in [file_id for file_id, cached in self.paths.items() if cached == path]:
+            del self.paths[file_id]
+
+    def remove_finished(self):
+        deadline = time.monotonic() - self.keep
+        for path, finished_at in list(self.finished.items()):
+            if finished_at <= deadline and path not in self.in_use:
+                del self.finished[path]
+                self._remove(path)
+
+    async def _cleanup_loop(self):
+        while self.finished:
+            await asyncio.sleep(self.cleanup_interval)
+            self.remove_finished()
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'in_use': len(self.in_use),
+            'waiting_removal': len(self.finished),
+            'removed': self.removed,
+            'removed_bytes': self.removed_bytes,
+        }
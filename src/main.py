@@ -1,10 +1,12 @@
 import asyncio
+import functools
 import io
 import os
 import re
+import tempfile
 import uuid
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Awaitable, Optional, List, Tuple
 
 from aiogram import Bot, Dispatcher, types as tgtypes
 from aiogram import filters
@@ -12,20 +14,42 @@ from aiogram.dispatcher import FSMContext
 from aiogram.bot.api import TelegramAPIServer
 from aiograph import Telegraph
 from bson import ObjectId
-from htmlshare_api import upload_html
+from htmlshare_api import upload_html, search_html
 
 from motor import motor_asyncio
 
-from db import get_db, User, get_fsm_storage
+from db import get_db, User, get_fsm_storage, HtmlshareMigration
 from middleware import UserAuthMiddleware, only_for_registered, only_for_admin, StackForwardedMessagesMiddleware, \
-    stack_forwarded_messages
+    stack_forwarded_messages, AdmissionControlMiddleware
 from raindrop_api import RaindropApi, SpecialCollectionIds, SortOrder
-from fsm import ConfigFlow, SettingsFlow
-from utils import get_logger, URL_REGEX, IS_DEV, URL_REGEX_STRICT, RUN_IN_DOCKER, generate_post_pretty_html, \
-    guess_title, extract_forward_source
+from fsm import ConfigFlow, SettingsFlow, ImportFlow
+from bulk_import import import_links, iter_links_from_file, iter_links_from_lines, unique_links, \
+    is_importable_file, throttled_progress, ImportInterrupted, IMPORT_MAX_LINKS
+from collections_cache import CollectionsCache
+from admission import AdmissionController
+from backlog import BacklogDrainer
+from circuit_breaker import ServiceUnavailable, raindrop_breaker, htmlshare_breaker, telegraph_breaker
+from images import ImagePreparer
+from export import EXPORT_FORMATS, export_raindrops, export_filename
+from htmlshare_migration import HtmlshareMigrationJob, migration_available
+from local_files import LocalBotFiles
+from inline_pages import InlinePagesCache, LatestQueryRunner, QuerySuperseded
+from parked_saves import ParkedSaves, SaveProgress
+from profiler import Profiler
+from recent_links import RecentLinks
+from utils import get_logger, URL_REGEX, IS_DEV, URL_REGEX_STRICT, generate_post_pretty_html, \
+    guess_title, extract_forward_sources, drops_to_inline_results, html_hits_to_inline_results
 
 logger = get_logger('bot')
 
+# Telegram allows at most 50 results per answer to inline query
+INLINE_PAGE_SIZE = 50
+# Inline queries starting with it search text of saved Telegram posts instead of raindrops
+POSTS_SEARCH_PREFIX = 'posts:'
+UNSORTED_TITLE = 'Unsorted'
+MAX_COLLECTION_BUTTONS = 100
+MAX_INLINE_COLLECTION_BUTTONS = 8
+
 
 class RaindropioBot:
     def __init__(self, event_loop: asyncio.AbstractEventLoop):
@@ -49,6 +73,20 @@ class RaindropioBot:
             self.telegraph = None
         with open('misc/post_template.html') as f:
             self.post_template = f.read()
+        self.inline_pages = InlinePagesCache.from_env()
+        self.inline_searches = LatestQueryRunner.from_env()
+        self.collections = CollectionsCache.from_env()
+        self.images = ImagePreparer.from_env()
+        self.admission = AdmissionController.from_env()
+        self.parked_saves = ParkedSaves.from_env()
+        self.local_files = LocalBotFiles.from_env(self.bot)
+        self.recent_links = RecentLinks.from_env()
+        self.profiler = Profiler()
+        self.backlog = BacklogDrainer.from_env(self.bot, self.process_backlog_update)
+        self.backlog_tasks = set()
+        self.background_tasks = set()
+        self.migrations = set()
+        self.exports = set()
 
     def attach_listeners(self):
         self.register_command_and_text_handlers(self.on_help, 'help')
@@ -69,10 +107,24 @@ class RaindropioBot:
 
         self.dispatcher.register_message_handler(self.update_api_key, state=SettingsFlow.waiting_for_new_key)
 
+        self.dispatcher.register_message_handler(self.init_collection_change,
+                                                 filters.Text(equals='📁 Collection'),
+                                                 state=SettingsFlow.waiting_for_setting_select)
+
+        self.dispatcher.register_message_handler(self.update_default_collection,
+                                                 state=SettingsFlow.waiting_for_collection)
+
         self.dispatcher.register_message_handler(self.invalid_setting_picked,
-                                                 lambda message: message.text not in ["🔑 API key"],
+                                                 lambda message: message.text not in ["🔑 API key", "📁 Collection"],
                                                  state=SettingsFlow.waiting_for_setting_select)
 
+        self.register_command_and_text_handlers(self.on_import_init, 'import')
+        self.register_command_and_text_handlers(self.on_migrate, 'migrate')
+        self.register_command_and_text_handlers(self.on_export, 'export')
+        import_content_types = tgtypes.ContentTypes.TEXT | tgtypes.ContentTypes.DOCUMENT
+        self.dispatcher.register_message_handler(self.process_import, content_types=import_content_types,
+                                                 state=ImportFlow.waiting_for_links)
+
         supported_media_types = tgtypes.ContentTypes.VIDEO | tgtypes.ContentTypes.PHOTO | tgtypes.ContentTypes.DOCUMENT
         self.dispatcher.register_message_handler(self.process_message,
                                                  content_types=tgtypes.ContentTypes.TEXT | supported_media_types,
@@ -87,8 +139,11 @@ class RaindropioBot:
 
         self.register_command_and_text_handlers(self.on_stats, 'stats')
         self.register_command_and_text_handlers(self.on_broadcast_shutdown, 'broadcast_shutdown')
+        self.register_command_and_text_handlers(self.on_profile, 'profile')
 
         self.dispatcher.register_inline_handler(self.on_inline_search)
+        self.dispatcher.register_callback_query_handler(self.on_move_to_collection,
+                                                        lambda query: (query.data or '').startswith('move:'))
 
         self.dispatcher.register_message_handler(self.on_unknown_commands)
 
@@ -97,6 +152,8 @@ class RaindropioBot:
             tgtypes.BotCommand('/help', 'Help me pleaaase!~'),
             tgtypes.BotCommand('/config', 'Let you configure this bot'),
             tgtypes.BotCommand('/settings', 'Change your settings'),
+            tgtypes.BotCommand('/import', 'Save a lot of links at once'),
+            tgtypes.BotCommand('/export', 'Download all your raindrops'),
         ]
         await self.bot.set_my_commands(commands)
 
@@ -139,6 +196,7 @@ class RaindropioBot:
         keyboard_markup = tgtypes.ReplyKeyboardMarkup(row_width=2)
         keyboard_markup.add(
             tgtypes.KeyboardButton('🔑 API key'),
+            tgtypes.KeyboardButton('📁 Collection'),
             tgtypes.KeyboardButton('❌ Cancel')
         )
         await message.reply('What would you like to change?', reply_markup=keyboard_markup)
@@ -147,6 +205,36 @@ class RaindropioBot:
         await SettingsFlow.waiting_for_new_key.set()
         await message.reply('Okay, just send me new key', reply_markup=tgtypes.ReplyKeyboardRemove())
 
+    async def init_collection_change(self, message: tgtypes.Message, state: FSMContext, user: User):
+        tree = await self.collections.get(user.telegram_id, RaindropApi(user.raindrop_api_key))
+        if tree is None:
+            await message.reply("Unknown error :(\n\nI couldn't load your collections, please try again later")
+            return
+
+        await SettingsFlow.waiting_for_collection.set()
+        keyboard_markup = tgtypes.ReplyKeyboardMarkup(row_width=1)
+        keyboard_markup.add(tgtypes.KeyboardButton(UNSORTED_TITLE))
+        for collection_id, path in tree.options()[:MAX_COLLECTION_BUTTONS]:
+            keyboard_markup.add(tgtypes.KeyboardButton(path))
+        keyboard_markup.add(tgtypes.KeyboardButton('❌ Cancel'))
+        await message.reply('Where should I save new raindrops by default?', reply_markup=keyboard_markup)
+
+    async def update_default_collection(self, message: tgtypes.Message, state: FSMContext, user: User):
+        if message.text == UNSORTED_TITLE:
+            collection_id = None
+        else:
+            tree = await self.collections.get(user.telegram_id, RaindropApi(user.raindrop_api_key))
+            collection_id = tree.find_by_path(message.text) if tree is not None else None
+            if collection_id is None:
+                await message.reply('Please select one of options')
+                return
+
+        user.default_collection_id = collection_id
+        await user.save(self.db)
+        await state.finish()
+        await message.reply(f'Okay, from now on I will save raindrops to {message.text}',
+                            reply_markup=tgtypes.ReplyKeyboardRemove())
+
     async def invalid_setting_picked(self, message: tgtypes.Message, user: User):
         await message.reply('Please select one of options')
 
@@ -154,7 +242,10 @@ class RaindropioBot:
         await message.reply('Okay! Let me check this key...')
         if await RaindropApi.check_token(message.text):
             user.raindrop_api_key = message.text
+            user.default_collection_id = None
             await user.save(self.db)
+            self.collections.invalidate(user.telegram_id)
+            self.recent_links.forget_user(user.telegram_id)
             await state.finish()
             await message.reply("Raindrop API token updated.")
         else:
@@ -188,10 +279,17 @@ class RaindropioBot:
                      "and send me any link :)\n" \
                      "✔️ Easily share your raindrops in other chats, just type `@raindropiobot <search query>` in any " \
                      "chat and pick which raindrop you would like to share. You can use all " \
-                     "[advanced parameters](https://help.raindrop.io/using-search#operators) in search query.\n" \
+                     "[advanced parameters](https://help.raindrop.io/using-search#operators) in search query. " \
+                     f"Start query with `{POSTS_SEARCH_PREFIX}` to search text of Telegram posts you saved.\n" \
                      "✔️ Save forwarded posts to Raindrop (no more 'Saved Messages' cluttered with longreads!). " \
                      "Just forward me one of more messages and I'll try to guess is it just announce with link or " \
-                     "article itself and handle it accordingly."
+                     "article itself and handle it accordingly." \
+                     "\n✔️ Import a lot of links at once, just send me /import and then message or bookmarks " \
+                     "file with links." \
+                     "\n✔️ Download all your raindrops with /export (add `jsonl` or `html` for other formats and " \
+                     "`gz` to compress)."
+        if migration_available():
+            help_text += "\n✔️ Move posts saved by older version of this bot to the new server with /migrate."
 
         help_text += "\n\nPlease, note that this bot isn't affiliated with Raindrop.io and being developed and "
         help_text += f"supported on non-profit basis. You can check out source code [here]({repo_link}) and ask "
@@ -204,69 +302,236 @@ class RaindropioBot:
     @only_for_registered
     async def process_link(self, message: tgtypes.Message, user: User):
         link = message.text
-        logger.info(f'Got link {link}')
+        logger.info('Got link %s', link)
+
+        api = RaindropApi(user.raindrop_api_key)
+        saved_id = await self.recent_links.find(user.telegram_id, link, api)
+        if saved_id is not None:
+            await message.reply('Already saved!', reply_markup=self.collections_keyboard(user, saved_id))
+            return
 
         reply = await message.reply('Saving link...')
+        save = functools.partial(self.save_link, user, link, reply)
+        try:
+            await save()
+        except ServiceUnavailable as e:
+            logger.warning(f'Failed to save link from user {user.telegram_id}: {e}')
+            if self.parked_saves.park(message, save):
+                await reply.edit_text(f"{e.service} is not available right now, I'll save this as soon as it's back")
+            else:
+                await reply.edit_text(f'{e.service} is not available right now, please try again later')
+
+    async def save_link(self, user: User, link: str, reply: tgtypes.Message):
         api = RaindropApi(user.raindrop_api_key)
-        result = await api.raindrops.create(link)
+        result = await api.raindrops.create(link, collection_id=user.default_collection_id)
 
         if result:
-            await reply.edit_text("Saved in Unsorted!", parse_mode='markdown')
+            self.recent_links.remember(user.telegram_id, link, result.id)
+            await reply.edit_text(f"Saved in {self.collection_title(user)}!",
+                                  reply_markup=self.collections_keyboard(user, result.id))
         else:
             await reply.edit_text("Unknown error :(\n\n"
                                   "Is your API key still valid? You can change it in /settings")
 
     @only_for_registered
-    @stack_forwarded_messages
-    async def process_message(self, message: tgtypes.Message, user: User,
-                              all_messages: Optional[List[tgtypes.Message]] = None):
+    async def on_export(self, message: tgtypes.Message, user: User):
+        args = (message.get_args() or '').lower().split()
+        export_format = next((arg for arg in args if arg in EXPORT_FORMATS), 'csv')
+        compress = 'gz' in args or 'gzip' in args
+        if user.telegram_id in self.exports:
+            await message.reply('Export is already running, please wait')
+            return
 
-        messages = all_messages or [message]
-        api = RaindropApi(user.raindrop_api_key)
+        reply = await message.reply('Exporting your raindrops...')
 
-        if len(messages) > 1:
-            result_html = ''
-            result_text = ''
-            source = None
-            for index, message in enumerate(messages):
-                if message.photo is not None and len(message.photo) > 0:
-                    if self.telegraph is not None:
-                        attachment = sorted(message.photo, key=lambda x: x.width, reverse=True)[0]
-                        name = f'{uuid.uuid4()}.jpg'
-                        mime = 'image/jpg'
-                        attachment_file = await self.file_id_to_bytesio(attachment.file_id)
-                        links = await self.telegraph.upload((name, attachment_file, mime))
-                        attachment_file.close()
-                        result_html += f'<img src="{links[0]}">'
-                    else:
-                        result_html += '[There should be picture. If you would like to display them here, please ' \
-                                       'setup Telegraf integration for Raindrop telegram bot.]'
+        async def report_progress(exported: int, pages: int, total: Optional[int]):
+            await reply.edit_text(f'Exporting your raindrops... {exported} so far')
 
-                current_source, link = await extract_forward_source(message)
+        async def export():
+            api = RaindropApi(user.raindrop_api_key)
+            try:
+                result = await export_raindrops(api, export_format, compress, throttled_progress(report_progress))
+            except Exception:
+                logger.exception(f'Error while exporting raindrops of user {user.telegram_id}')
+                await reply.edit_text('Unknown error :(\n\nIs your API key still valid? You can change it in /settings')
+                return
+            finally:
+                self.exports.discard(user.telegram_id)
+            hint = '' if compress else '\n\nTry /export gz, compressed export is several times smaller'
+            try:
+                result.seek(0, os.SEEK_END)
+                size = result.tell()
+                result.seek(0)
+                # Bot API limit for files sent by bots
+                max_size = 1024 * 1024 * 50 if self.using_default_bot_server else 1024 * 1024 * 2000
+                if size > max_size:
+                    await reply.edit_text(f'Export is {size / 1024 / 1024:.0f} MB, it is too big to send{hint}')
+                    return
+                await message.reply_document(tgtypes.InputFile(result, export_filename(export_format, compress)))
+                await reply.delete()
+            except Exception:
+                logger.exception(f'Error while sending export of user {user.telegram_id}')
+                await reply.edit_text(f'Could not send the export :({hint}')
+            finally:
+                result.close()
+
+        # Big libraries take minutes because of Raindrop rate limits, so it's not holding handler
+        self.exports.add(user.telegram_id)
+        self.run_in_background(export())
 
-                if source != current_source:
-                    from_same_source = False
-                else:
-                    from_same_source = True
+    @only_for_registered
+    async def on_migrate(self, message: tgtypes.Message, user: User):
+        if not migration_available():
+            await message.reply('There is nothing to migrate, posts are already stored on the current server')
+            return
+        if user.telegram_id in self.migrations:
+            await message.reply('Migration is already running, please wait')
+            return
 
-                source = current_source
+        reply = await message.reply('Looking for posts to move...')
 
-                result_html += await generate_post_pretty_html(message, include_forward_from=not from_same_source)
-                result_text += (message.text or message.caption or '') + '\n'
+        async def report_progress(processed: int, migrated: int, total: int):
+            await reply.edit_text(f'Moving posts... {processed}/{total}')
 
-            result_html = self.post_template.replace("{{text}}", result_html)
-            title = guess_title(result_text) or 'Saved from Telegram'
-            html_uploaded_url = await upload_html(result_html)
-            if html_uploaded_url is None:
-                await message.reply('Unknown error :(')
+        async def migrate():
+            api = RaindropApi(user.raindrop_api_key)
+            job = HtmlshareMigrationJob(self.db, user.telegram_id, api, on_progress=throttled_progress(report_progress))
+            try:
+                total, migrated = await job.run()
+            except Exception:
+                logger.exception(f'Error while migrating posts of user {user.telegram_id}')
+                await reply.edit_text('Unknown error :(\n\nSend /migrate again to continue where it stopped')
                 return
-            raindrop = await api.raindrops.create(html_uploaded_url, please_parse=False, title=title, description='')
-            
+            finally:
+                self.migrations.discard(user.telegram_id)
+            if total == migrated:
+                await reply.edit_text(f'Done! Moved {migrated} posts.')
+            else:
+                await reply.edit_text(f'Moved {migrated} of {total} posts. Send /migrate again to retry the rest')
+
+        # Could take a while, so it's not holding handler
+        self.migrations.add(user.telegram_id)
+        self.run_in_background(migrate())
+
+    @only_for_registered
+    async def on_import_init(self, message: tgtypes.Message, user: User):
+        await ImportFlow.waiting_for_links.set()
+        await message.reply('Send me a message with links or a bookmarks file (.txt, .csv or .html) and I will save '
+                            f'all links from it to {self.collection_title(user)} (up to {IMPORT_MAX_LINKS} at once). '
+                            'If you changed your mind, just send me /cancel.')
+
+    @only_for_registered
+    async def process_import(self, message: tgtypes.Message, state: FSMContext, user: User):
+        if message.document is not None:
+            name = message.document.file_name
+            if not is_importable_file(name):
+                await message.reply('I can import links only from .txt, .csv or .html files')
+                return
+
+            if self.using_default_bot_server and message.document.file_size > 1024 * 1024 * 20:
+                await message.reply('Your file is too big :(\n\n'
+                                    'Telegram allows us to only download files 20MB (or less)')
+                return
+
+            if self.using_default_bot_server:
+                # Downloaded in chunks to disk, so big file isn't held in memory while it's parsed
+                attachment_file = tempfile.TemporaryFile()
+                try:
+                    await self.bot.download_file_by_id(message.document.file_id, destination=attachment_file)
+                except BaseException:
+                    attachment_file.close()
+                    raise
+            else:
+                attachment_file = await self.file_id_to_bytesio(message.document.file_id)
+            try:
+                # Parsing big file takes a while, so it's done in thread to not block other users
+                links = await self.loop.run_in_executor(
+                    None, lambda: unique_links(iter_links_from_file(attachment_file, name))
+                )
+            finally:
+                attachment_file.close()
+        else:
+            links = unique_links(iter_links_from_lines((message.text or '').splitlines()))
+
+        if not links:
+            await message.reply("I couldn't find any links there. Try another message or send me /cancel")
+            return
+
+        await state.finish()
+        reply = await message.reply(f'Importing {len(links)} links...')
+
+        async def report_progress(processed: int, created: int, total: int):
+            await reply.edit_text(f'Importing links... {processed}/{total}')
+
+        api = RaindropApi(user.raindrop_api_key)
+        try:
+            created = await import_links(api, links, throttled_progress(report_progress),
+                                         collection_id=user.default_collection_id)
+        except ImportInterrupted as e:
+            await reply.edit_text(f'{e.service} is not available right now. Saved {e.created} of {len(links)} links '
+                                  f'before that, please try again later')
+            return
+        if created == len(links):
+            await reply.edit_text(f'Done! Saved {created} links in {self.collection_title(user)}.')
+            await self.register_bot_usage(user)
+        elif created:
+            await reply.edit_text(f'Saved {created} of {len(links)} links in {self.collection_title(user)}, '
+                                  f'the rest failed. Send them again with /import to retry.')
+            await self.register_bot_usage(user)
+        else:
+            await reply.edit_text("Unknown error :(\n\n"
+                                  "Is your API key still valid? You can change it in /settings")
+
+    @only_for_registered
+    @stack_forwarded_messages
+    async def process_message(self, message: tgtypes.Message, user: User,
+                              all_messages: Optional[List[tgtypes.Message]] = None):
+        messages = all_messages or [message]
+        progress = SaveProgress()
+        save = functools.partial(self.save_messages, message, user, messages, progress)
+        try:
+            await save()
+        except ServiceUnavailable as e:
+            logger.warning(f'Failed to save message from user {user.telegram_id}: {e}')
+            discard = functools.partial(self.discard_save, user, progress)
+            if self.parked_saves.park(message, save, discard):
+                await message.reply(f"{e.service} is not available right now, I'll save this as soon as it's back")
+            else:
+                await discard()
+                await message.reply(f'{e.service} is not available right now, please try again later')
+
+    async def discard_save(self, user: User, progress: SaveProgress):
+        # Placeholder raindrop without attachment is useless, so it's removed when save is given up
+        if progress.placeholder_id is None:
+            return
+        try:
+            await RaindropApi(user.raindrop_api_key).raindrops.delete(progress.placeholder_id)
+            progress.placeholder_id = None
+        except ServiceUnavailable:
+            logger.warning(f'Could not delete placeholder raindrop {progress.placeholder_id}, Raindrop is down')
+
+    async def save_messages(self, message: tgtypes.Message, user: User, messages: List[tgtypes.Message],
+                            progress: SaveProgress):
+        # Can be called again with the same progress if it failed with ServiceUnavailable, steps which were done
+        # by previous attempt are skipped
+        api = RaindropApi(user.raindrop_api_key)
+
+        if len(messages) > 1:
+            if progress.html_url is None:
+                html, title = await self.format_stack(messages)
+                html_uploaded_url = await upload_html(html, title, user.telegram_id)
+                if html_uploaded_url is None:
+                    await message.reply('Unknown error :(')
+                    return
+                progress.html_url, progress.title = html_uploaded_url, title
+            raindrop = await api.raindrops.create(progress.html_url, please_parse=False, title=progress.title,
+                                                  description='', collection_id=user.default_collection_id)
+
             if raindrop is None:
                 await message.reply('Unknown error :(')
                 return
 
-            await message.reply('Saved!')
+            await message.reply('Saved!', reply_markup=self.collections_keyboard(user, raindrop.id))
             await self.register_bot_usage(user)
 
         else:
@@ -317,11 +582,16 @@ class RaindropioBot:
 
             if has_links and text_len < 700 and all_links_have_same_url:
                 # This is probably some kind of announce and short description for shared article
-                raindrop = await api.raindrops.create(links_to)
+                saved_id = await self.recent_links.find(user.telegram_id, links_to, api)
+                if saved_id is not None:
+                    await message.reply('Already saved!', reply_markup=self.collections_keyboard(user, saved_id))
+                    return
+                raindrop = await api.raindrops.create(links_to, collection_id=user.default_collection_id)
                 if not raindrop:
                     await message.reply('Unknown error :(')
                 else:
-                    await message.reply('Saved!')
+                    self.recent_links.remember(user.telegram_id, links_to, raindrop.id)
+                    await message.reply('Saved!', reply_markup=self.collections_keyboard(user, raindrop.id))
                     await self.register_bot_usage(user)
             elif has_supported_attachment:
                 if message.photo is not None and len(message.photo) > 0:
@@ -343,39 +613,51 @@ class RaindropioBot:
                                         'Raindrop supports only files up to 100MB')
                     return
 
-                title = guess_title(message.caption) or 'Saved from Telegram'
-                raindrop = await api.raindrops.create(f'http://example.com/{uuid.uuid4()}', please_parse=False,
-                                                      title=title, description='')
-                if raindrop is None:
-                    await message.reply('Unknown error :(')
-                    return
-
+                if progress.placeholder_id is None:
+                    title = guess_title(message.caption) or 'Saved from Telegram'
+                    raindrop = await api.raindrops.create(f'http://example.com/{uuid.uuid4()}', please_parse=False,
+                                                          title=title, description='',
+                                                          collection_id=user.default_collection_id)
+                    if raindrop is None:
+                        await message.reply('Unknown error :(')
+                        return
+                    progress.placeholder_id = raindrop.id
+                raindrop_id = progress.placeholder_id
 
                 if self.using_default_bot_server:
                     attachment_file = await self.bot.download_file_by_id(attachment.file_id)
                 else:
-                    attachment_file = await self.file_id_to_bytesio(attachment.file_id)
-
-                result = await api.raindrops.upload_file(raindrop.id, attachment_file, name, mime)
-                attachment_file.close()
+                    # Up to 100 MB, so it's uploaded right from mapped file instead of being read into memory
+                    attachment_file = await self.local_files.open(attachment.file_id, mapped=True)
+
+                try:
+                    result = await api.raindrops.upload_file(raindrop_id, attachment_file, name, mime)
+                finally:
+                    # Local file must be closed to be counted as finished and cleaned up later
+                    attachment_file.close()
                 if result:
-                    await message.reply('Saved!')
+                    progress.placeholder_id = None
+                    await message.reply('Saved!', reply_markup=self.collections_keyboard(user, raindrop_id))
                     await self.register_bot_usage(user)
                 else:
+                    await self.discard_save(user, progress)
                     await message.reply('Unknown error :(')
             else:
-                title = guess_title(message.text) or 'Saved from Telegram'
-                html = await self.format_post(message, True)
-                html_uploaded_url = await upload_html(html)
-                if html_uploaded_url is None:
-                    await message.reply('Unknown error :(')
-                    return
-                raindrop = await api.raindrops.create(html_uploaded_url, please_parse=False, title=title, description='')
+                if progress.html_url is None:
+                    title = guess_title(message.text) or 'Saved from Telegram'
+                    html = await self.format_post(message, True)
+                    html_uploaded_url = await upload_html(html, title, user.telegram_id)
+                    if html_uploaded_url is None:
+                        await message.reply('Unknown error :(')
+                        return
+                    progress.html_url, progress.title = html_uploaded_url, title
+                raindrop = await api.raindrops.create(progress.html_url, please_parse=False, title=progress.title,
+                                                      description='', collection_id=user.default_collection_id)
                 if raindrop is None:
                     await message.reply('Unknown error :(')
                     return
 
-                await message.reply('Saved!')
+                await message.reply('Saved!', reply_markup=self.collections_keyboard(user, raindrop.id))
                 await self.register_bot_usage(user)
 
 
@@ -391,11 +673,32 @@ class RaindropioBot:
         active_in_last_month = await self.db[User.collection].count_documents({
             'last_used': {'$gt': datetime.utcnow() - timedelta(days=30)}
         })
-        await message.reply('**Stats:**\n'
-                            f'Total users: {total_users}\n'
-                            f'Active in last week: {active_in_last_week}\n'
-                            f'Active in last month: {active_in_last_month}\n',
-                            parse_mode='markdown')
+        stats = '**Stats:**\n' \
+                f'Total users: {total_users}\n' \
+                f'Active in last week: {active_in_last_week}\n' \
+                f'Active in last month: {active_in_last_month}\n'
+        if self.images.enabled:
+            stats += f'Images prepared: {self.images.images_processed}, ' \
+                     f'saved {self.images.bytes_saved / 1024 / 1024:.1f} MB\n'
+        admission = self.admission.stats()
+        stats += f'Updates in flight: {admission["in_flight"]}, waiting: {admission["waiting"]}, ' \
+                 f'rejected: {admission["rejected"]}\n' \
+                 f'Queue wait: avg {admission["avg_wait"] * 1000:.0f} ms, max {admission["max_wait"] * 1000:.0f} ms\n'
+        for breaker in [raindrop_breaker, htmlshare_breaker, telegraph_breaker]:
+            stats += breaker.stats() + '\n'
+        if self.backlog.total:
+            stats += f'Backlog after start: {self.backlog.progress()}\n'
+        recent = self.recent_links.stats()
+        stats += f'Duplicate saves answered from cache: {recent["hits"]}, ' \
+                 f'found in Raindrop: {recent["raindrop_hits"]} of {recent["raindrop_checks"]} checks\n'
+        if not self.using_default_bot_server:
+            local_files = self.local_files.stats()
+            stats += f'Local files: {local_files["hits"]} of {local_files["lookups"]} lookups cached, ' \
+                     f'{local_files["removed"]} removed ({local_files["removed_bytes"] / 1024 / 1024:.1f} MB)\n'
+        if self.parked_saves.enabled:
+            stats += f'Parked saves: {len(self.parked_saves.items)}, retried: {self.parked_saves.retried}, ' \
+                     f'expired: {self.parked_saves.expired}\n'
+        await message.reply(stats, parse_mode='markdown')
     
     @only_for_admin
     async def on_broadcast_shutdown(self, message: tgtypes.Message):
@@ -412,6 +715,24 @@ class RaindropioBot:
                 logger.info(f'Message sent to {user.telegram_id}')
             await asyncio.sleep(.05)
 
+    @only_for_admin
+    async def on_profile(self, message: tgtypes.Message):
+        args = message.get_args()
+        seconds = int(args) if args and args.isdigit() else 30
+        if self.profiler.running:
+            await message.reply('Profiler is already running')
+            return
+
+        await message.reply(f'Profiling for {seconds} seconds...')
+        report = await self.profiler.profile(seconds)
+        summary = f'Profiled {report.seconds:.0f}s, {report.samples} samples\n' \
+                  f'Event loop lag: {report.lag_summary()}\n\n' \
+                  f'Top allocations:\n' + '\n'.join(report.allocations)
+        await message.reply_document(tgtypes.InputFile(io.BytesIO(report.collapsed.encode()), 'profile.folded'),
+                                     caption='Collapsed stacks, open with speedscope.app or flamegraph.pl')
+        await message.reply_document(tgtypes.InputFile(io.BytesIO(summary.encode()), 'profile_summary.txt'),
+                                     caption=f'Event loop lag: {report.lag_summary()}')
+
     async def on_inline_search(self, inline_query: tgtypes.InlineQuery, user: User):
         if user is None:
             await self.bot.answer_inline_query(inline_query.id, results=[],
@@ -421,33 +742,169 @@ class RaindropioBot:
             return
 
         text = inline_query.query or ''
+        offset = inline_query.offset or ''
+        page = int(offset) if offset.isdigit() else 0
         api = RaindropApi(user.raindrop_api_key)
-        if text:
-            drops = await api.raindrops.get(collection_id=SpecialCollectionIds.all, search=text)
-        else:
-            drops = await api.raindrops.get(collection_id=SpecialCollectionIds.all, sort=SortOrder.created_asc)
-        results = []
-        for drop in drops:
-            input_content = tgtypes.InputTextMessageContent(drop.to_pretty('markdown'), parse_mode='markdown')
-            results.append(tgtypes.InlineQueryResultArticle(id=drop.id, title=drop.title, description=drop.description,
-                                                            url=drop.link, input_message_content=input_content,
-                                                            thumb_url=drop.cover))
+        user_id = inline_query.from_user.id
+
+        if text.lower().startswith(POSTS_SEARCH_PREFIX):
+            await self.on_inline_posts_search(inline_query, text[len(POSTS_SEARCH_PREFIX):].strip(), page)
+            return
 
+        key = (user_id, text, page)
+        fetch_page = functools.partial(self.inline_pages.get, key, self.inline_page_fetcher(api, text, page))
+        try:
+            if page == 0 and not self.inline_pages.is_cached(key):
+                # User is still typing, only the latest query is worth answering
+                drops = await self.inline_searches.run(user_id, fetch_page)
+            else:
+                drops = await fetch_page()
+        except QuerySuperseded:
+            logger.debug('Inline query %s superseded by newer one', inline_query.id)
+            return
+        except ServiceUnavailable as e:
+            await self.answer_unavailable(inline_query, e.service)
+            return
+        results = drops_to_inline_results(drops)
+
+        has_next_page = len(drops) == INLINE_PAGE_SIZE
         await self.bot.answer_inline_query(inline_query.id, results=results,
                                            cache_time=1 if IS_DEV else 300,
-                                           is_personal=True)
+                                           is_personal=True,
+                                           next_offset=str(page + 1) if has_next_page else '')
+        if has_next_page:
+            self.inline_pages.prefetch((user_id, text, page + 1), self.inline_page_fetcher(api, text, page + 1))
+
+    async def on_inline_posts_search(self, inline_query: tgtypes.InlineQuery, text: str, page: int):
+        # Searches text of saved Telegram posts, which Raindrop itself doesn't index
+        user_id = inline_query.from_user.id
+        search = functools.partial(search_html, text, user_id, page, INLINE_PAGE_SIZE)
+        try:
+            hits = await self.inline_searches.run(user_id, search) if page == 0 else await search()
+        except QuerySuperseded:
+            logger.debug('Inline query %s superseded by newer one', inline_query.id)
+            return
+        except ServiceUnavailable as e:
+            await self.answer_unavailable(inline_query, e.service)
+            return
+
+        await self.bot.answer_inline_query(inline_query.id, results=html_hits_to_inline_results(hits),
+                                           cache_time=1 if IS_DEV else 300,
+                                           is_personal=True,
+                                           next_offset=str(page + 1) if len(hits) == INLINE_PAGE_SIZE else '')
+
+    async def answer_unavailable(self, inline_query: tgtypes.InlineQuery, service: str):
+        # Not cached, so search works again as soon as service is back
+        await self.bot.answer_inline_query(inline_query.id, results=[], cache_time=1, is_personal=True,
+                                           switch_pm_text=f'{service} is not available right now',
+                                           switch_pm_parameter='unavailable')
+
+    @staticmethod
+    def inline_page_fetcher(api: RaindropApi, text: str, page: int):
+        async def fetch():
+            if text:
+                return await api.raindrops.get(collection_id=SpecialCollectionIds.all, search=text, page=page,
+                                               per_page=INLINE_PAGE_SIZE)
+            return await api.raindrops.get(collection_id=SpecialCollectionIds.all, sort=SortOrder.created_asc,
+                                           page=page, per_page=INLINE_PAGE_SIZE)
+        return fetch
+
+    async def on_move_to_collection(self, callback_query: tgtypes.CallbackQuery, user: Optional[User]):
+        if user is None:
+            await callback_query.answer('You need to register first')
+            return
+
+        _, raindrop_id, collection_id = callback_query.data.split(':')
+        api = RaindropApi(user.raindrop_api_key)
+        try:
+            moved = await api.raindrops.move(int(raindrop_id), int(collection_id))
+        except ServiceUnavailable as e:
+            await callback_query.answer(f'{e.service} is not available right now, please try again later')
+            return
+        if not moved:
+            await callback_query.answer('Unknown error :(')
+            return
+
+        title = self.collection_title(user, int(collection_id))
+        await callback_query.answer(f'Moved to {title}')
+        await callback_query.message.edit_text(f'Saved in {title}!')
+
+    def collection_title(self, user: User, collection_id: Optional[int] = None) -> str:
+        collection_id = collection_id or user.default_collection_id
+        if collection_id is None or collection_id == SpecialCollectionIds.unsorted:
+            return UNSORTED_TITLE
+        tree = self.collections.peek(user.telegram_id, RaindropApi(user.raindrop_api_key))
+        if tree is None:
+            return 'your collection'
+        return tree.paths.get(collection_id, 'your collection')
+
+    def collections_keyboard(self, user: User, raindrop_id: int) -> Optional[tgtypes.InlineKeyboardMarkup]:
+        # Uses only cached tree, so saving is never slowed down by fetching collections
+        tree = self.collections.peek(user.telegram_id, RaindropApi(user.raindrop_api_key))
+        if tree is None or not tree.collections:
+            return None
+
+        keyboard_markup = tgtypes.InlineKeyboardMarkup(row_width=2)
+        current = user.default_collection_id or SpecialCollectionIds.unsorted
+        options = [(SpecialCollectionIds.unsorted, UNSORTED_TITLE)] + tree.options()
+        options = [(collection_id, path) for collection_id, path in options if collection_id != current]
+        keyboard_markup.add(*[
+            tgtypes.InlineKeyboardButton(f'📁 {path}', callback_data=f'move:{raindrop_id}:{collection_id}')
+            for collection_id, path in options[:MAX_INLINE_COLLECTION_BUTTONS]
+        ])
+        return keyboard_markup
 
     async def file_id_to_bytesio(self, file_id):
         if self.using_default_bot_server:
             return await self.bot.download_file_by_id(file_id)
         else:
-            attachment_info = await self.bot.get_file(file_id)
-            if RUN_IN_DOCKER:
-                path = attachment_info.file_path.replace('/srv/', '/raindropiobot/', 1)
+            return await self.local_files.open(file_id)
+
+    async def format_stack(self, messages: List[tgtypes.Message]) -> Tuple[str, str]:
+        # Returns HTML of the whole stack and its title
+        result_html = ''
+        result_text = ''
+        source = None
+        forward_sources = await extract_forward_sources(messages)
+        for index, message in enumerate(messages):
+            if message.photo is not None and len(message.photo) > 0:
+                if self.telegraph is not None:
+                    attachment = self.images.pick(message.photo)
+                    name = f'{uuid.uuid4()}.jpg'
+                    mime = 'image/jpeg'
+                    attachment_file = await self.file_id_to_bytesio(attachment.file_id)
+                    try:
+                        prepared_file = await self.images.prepare(attachment_file, attachment)
+                        try:
+                            links = await telegraph_breaker.call(self.telegraph.upload, (name, prepared_file, mime))
+                            result_html += f'<img src="{links[0]}">'
+                        except ServiceUnavailable:
+                            logger.exception('Error while uploading picture to Telegra.ph')
+                            result_html += '[There should be picture, but Telegra.ph is not available right now]'
+                        finally:
+                            prepared_file.close()
+                    finally:
+                        attachment_file.close()
+                else:
+                    result_html += '[There should be picture. If you would like to display them here, please ' \
+                                   'setup Telegraf integration for Raindrop telegram bot.]'
+
+            current_source, link = forward_sources[index]
+
+            if source != current_source:
+                from_same_source = False
             else:
-                path = attachment_info.file_path.replace('/srv/public/', './bot_server_volume/', 1)
-            attachment_file = open(path, 'rb')
-            return attachment_file
+                from_same_source = True
+
+            source = current_source
+
+            result_html += await generate_post_pretty_html(message, include_forward_from=not from_same_source,
+                                                           forward_source=forward_sources[index])
+            result_text += (message.text or message.caption or '') + '\n'
+
+        result_html = self.post_template.replace("{{text}}", result_html)
+        title = guess_title(result_text) or 'Saved from Telegram'
+        return result_html, title
 
     async def format_post(self, message: tgtypes.Message, include_forward_from: bool = True):
         text = await generate_post_pretty_html(message, include_forward_from=include_forward_from)
@@ -461,15 +918,48 @@ class RaindropioBot:
             '$set': user.mongo()
         })
 
-    async def start(self):
-        self.db = await get_db()
+    async def setup(self, db: Optional[motor_asyncio.AsyncIOMotorDatabase] = None):
+        self.db = db if db is not None else await get_db()
         await User.create_indexes(self.db)
+        await HtmlshareMigration.create_indexes(self.db)
         await self.set_commands()
         self.attach_listeners()
         self.dispatcher.middleware.setup(UserAuthMiddleware(self.db))
         self.dispatcher.middleware.setup(StackForwardedMessagesMiddleware())
-        await self.dispatcher.skip_updates()
-        await self.dispatcher.start_polling()
+        self.dispatcher.middleware.setup(AdmissionControlMiddleware(self.admission))
+
+    async def process_backlog_update(self, raw_update: dict):
+        # Every update gets its own task like in polling, so forwarded messages can be stacked
+        async def process():
+            try:
+                await self.dispatcher.process_update(tgtypes.Update(**raw_update))
+            except Exception:
+                logger.exception('Error while processing update from backlog')
+
+        task = asyncio.create_task(process())
+        self.backlog_tasks.add(task)
+        task.add_done_callback(self.backlog_tasks.discard)
+
+    def run_in_background(self, coroutine: Awaitable):
+        # Event loop keeps only weak references to tasks
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def start(self):
+        await self.setup()
+        Bot.set_current(self.bot)
+        Dispatcher.set_current(self.dispatcher)
+        await self.backlog.drain()
+        # Let backlog finish first, so new messages of the same user don't overtake it
+        await asyncio.gather(*self.backlog_tasks)
+        try:
+            await self.dispatcher.start_polling()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.images.shutdown()
 
 
 DEPRECATION_NOTICE = """
@@ -484,5 +974,10 @@ if __name__ == '__main__':
     logger.info("Starting bot. Getting event loop")
     loop = asyncio.get_event_loop()
     logger.info("Obtained event loop")
-    bot = RaindropioBot(loop)
-    loop.run_until_complete(bot.start())
+    workers = int(os.getenv('BOT_WORKERS', 1))
+    if workers > 1:
+        from sharding import ShardSupervisor
+        loop.run_until_complete(ShardSupervisor(workers).start())
+    else:
+        bot = RaindropioBot(loop)
+        loop.run_until_complete(bot.start())
@@ -7,10 +7,13 @@ from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.handler import CancelHandler, current_handler
 from motor import motor_asyncio
 
+from admission import AdmissionController, Overloaded
 from db import User
 from utils import get_logger
 
 logger = get_logger('bot')
+# Messages logged for every update, can be sampled with LOG_SAMPLING
+updates_logger = get_logger('bot.updates')
 
 
 class UserAuthMiddleware(BaseMiddleware):
@@ -21,7 +24,7 @@ class UserAuthMiddleware(BaseMiddleware):
     async def on_process_message(self, message: tgtypes.Message, data: dict):
         admin_id = int(os.getenv('ADMIN_TELEGRAM_ID', -1))
         handler = current_handler.get()
-        logger.info(f'Processing message from user {message.from_user.id}')
+        updates_logger.info('Processing message from user %s', message.from_user.id)
 
         if handler and getattr(handler, 'only_for_admin', False) and admin_id != message.from_user.id:
             await message.reply('This feature available only for admin!')
@@ -37,11 +40,14 @@ class UserAuthMiddleware(BaseMiddleware):
         data['user'] = user
 
     async def on_pre_process_inline_query(self, inline_query: tgtypes.InlineQuery, data: dict):
-        logger.info(f'Pre processing inline query from {inline_query.from_user.id}')
+        updates_logger.info('Pre processing inline query from %s', inline_query.from_user.id)
         user = await User.get_by_telegram_id(self.db, inline_query.from_user.id)
 
         data['user'] = user
 
+    async def on_pre_process_callback_query(self, callback_query: tgtypes.CallbackQuery, data: dict):
+        data['user'] = await User.get_by_telegram_id(self.db, callback_query.from_user.id)
+
 
 def only_for_registered(func):
     setattr(func, 'only_for_registered_users', True)
@@ -89,3 +95,51 @@ class StackForwardedMessagesMiddleware(BaseMiddleware):
 def stack_forwarded_messages(func):
     setattr(func, 'stack_forwarded_messages', True)
     return func
+
+
+class AdmissionControlMiddleware(BaseMiddleware):
+    # Must be set up after StackForwardedMessagesMiddleware: stacked forwards should take one slot, not one per message
+    OVERLOADED_TEXT = 'Bot is overloaded right now, please try again in a minute'
+
+    def __init__(self, controller: AdmissionController):
+        super().__init__()
+        self.controller = controller
+
+    async def _admit(self, user_id: int, data: dict) -> bool:
+        try:
+            await self.controller.acquire(user_id)
+        except Overloaded:
+            logger.warning(f'Rejected update from user {user_id}, stats: {self.controller.stats()}')
+            return False
+        data['admitted_user_id'] = user_id
+        return True
+
+    def _release(self, data: dict):
+        user_id = data.pop('admitted_user_id', None)
+        if user_id is not None:
+            self.controller.release(user_id)
+
+    async def on_process_message(self, message: tgtypes.Message, data: dict):
+        if not await self._admit(message.from_user.id, data):
+            await message.reply(self.OVERLOADED_TEXT)
+            raise CancelHandler()
+
+    async def on_process_inline_query(self, inline_query: tgtypes.InlineQuery, data: dict):
+        if not await self._admit(inline_query.from_user.id, data):
+            await inline_query.answer([], cache_time=0, is_personal=True)
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, callback_query: tgtypes.CallbackQuery, data: dict):
+        if not await self._admit(callback_query.from_user.id, data):
+            await callback_query.answer(self.OVERLOADED_TEXT)
+            raise CancelHandler()
+
+    async def on_post_process_message(self, message: tgtypes.Message, results: list, data: dict):
+        self._release(data)
+
+    async def on_post_process_inline_query(self, inline_query: tgtypes.InlineQuery, results: list, data: dict):
+        self._release(data)
+
+    async def on_post_process_callback_query(self, callback_query: tgtypes.CallbackQuery, results: list,
+                                             data: dict):
+        self._release(data)
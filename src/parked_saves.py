@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, NamedTuple, Optional
+
+from aiogram import types as tgtypes
+
+from circuit_breaker import ServiceUnavailable
+from utils import get_logger
+
+logger = get_logger('bot')
+
+
+class SaveProgress:
+    # Steps of a save which are already done. Parked save is retried with the same object, so retry continues where
+    # it failed instead of uploading post again or creating another raindrop
+    def __init__(self):
+        self.html_url = None  # type: Optional[str]
+        self.title = None  # type: Optional[str]
+        # Raindrop created for attachment which isn't uploaded yet
+        self.placeholder_id = None  # type: Optional[int]
+
+
+class ParkedSave(NamedTuple):
+    message: tgtypes.Message
+    save: Callable[[], Awaitable]
+    parked_at: float
+    # Cleans up what failed save left behind, called when it's given up
+    discard: Optional[Callable[[], Awaitable]]
+
+
+class ParkedSaves:
+    # Saves which failed because some service was down. They are retried in background until service recovers,
+    # save function is responsible for replying to user on success. Kept in memory, so restart drops them
+    def __init__(self, enabled: bool = False, max_items: int = 1000, retry_interval: float = 60,
+                 max_age: float = 6 * 60 * 60):
+        self.enabled = enabled
+        self.max_items = max_items
+        self.retry_interval = retry_interval
+        self.max_age = max_age
+        self.items = deque()  # type: Deque[ParkedSave]
+        self.task = None  # type: Optional[asyncio.Task]
+        self.retried = 0
+        self.expired = 0
+
+    @classmethod
+    def from_env(cls) -> 'ParkedSaves':
+        return cls(
+            enabled=os.getenv('PARK_FAILED_SAVES', 'false') == 'true',
+            retry_interval=float(os.getenv('PARKED_SAVES_RETRY_INTERVAL', 60)),
+            max_age=float(os.getenv('PARKED_SAVES_MAX_AGE', 6 * 60 * 60)),
+        )
+
+    def park(self, message: tgtypes.Message, save: Callable[[], Awaitable],
+             discard: Optional[Callable[[], Awaitable]] = None) -> bool:
+        if not self.enabled or len(self.items) >= self.max_items:
+            return False
+        self.items.append(ParkedSave(message, save, time.monotonic(), discard))
+        if self.task is None or self.task.done():
+            # Started from handler, so it inherits current Bot instance needed by message.reply()
+            self.task = asyncio.create_task(self._retry_loop())
+        return True
+
+    async def _retry_loop(self):
+        while self.items:
+            await asyncio.sleep(self.retry_interval)
+            await self.retry()
+
+    async def retry(self):
+        while self.items:
+            item = self.items[0]
+            if time.monotonic() - item.parked_at > self.max_age:
+                self.items.popleft()
+                self.expired += 1
+                await self._discard(item)
+                await self._reply(item.message, "Sorry, I couldn't save this message. Please send it again")
+                continue
+            try:
+                await item.save()
+            except ServiceUnavailable as e:
+                # Still down, no reason to try the rest of the queue now
+                logger.info(f'{e.service} is still unavailable, {len(self.items)} saves parked')
+                return
+            except Exception:
+                logger.exception('Error while retrying parked save')
+                await self._discard(item)
+                await self._reply(item.message, 'Unknown error :(')
+            self.items.popleft()
+            self.retried += 1
+
+    @staticmethod
+    async def _discard(item: ParkedSave):
+        if item.discard is None:
+            return
+        try:
+            await item.discard()
+        except Exception:
+            logger.exception('Error while discarding parked save')
+
+    @staticmethod
+    async def _reply(message: tgtypes.Message, text: str):
+        try:
+            await message.reply(text)
+        except Exception as e:
+            logger.exception(f'Error sending message {e}')
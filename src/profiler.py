@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Counter, List, NamedTuple, Optional
+
+# Frames of event loop machinery are the same in every sample, they only make flamegraph deeper
+SKIPPED_MODULES = (os.path.join('asyncio', 'events.py'), os.path.join('asyncio', 'base_events.py'),
+                   os.path.join('asyncio', 'runners.py'), os.path.join('asyncio', 'tasks.py'))
+IDLE_FUNCTIONS = {'select', 'poll'}
+
+
+class ProfileReport(NamedTuple):
+    seconds: float
+    samples: int
+    collapsed: str
+    allocations: List[str]
+    lag: List[float]
+
+    def lag_summary(self) -> str:
+        if not self.lag:
+            return 'no data'
+        lag = sorted(self.lag)
+        return f'p50 {lag[len(lag) // 2] * 1000:.1f} ms, p99 {lag[int(len(lag) * 0.99)] * 1000:.1f} ms, ' \
+               f'max {lag[-1] * 1000:.1f} ms'
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        if not frame.f_code.co_filename.endswith(SKIPPED_MODULES):
+            names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    # Samples stack of event loop thread from separate thread, so profiled code isn't instrumented at all.
+    # Coroutine that is running at the moment has all its awaiting callers on the stack, so samples show whole
+    # await chain. Samples when loop waits for IO are counted as idle
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()  # type: Counter[str]
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        if frame.f_code.co_name in IDLE_FUNCTIONS:
+            self.stacks['<idle>'] += 1
+        else:
+            self.stacks[_collapse(frame) or '<event loop>'] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        # Format of Brendan Gregg's flamegraph.pl and speedscope: "frame;frame;frame count"
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common())
+
+
+async def _measure_lag(lag: List[float], stop: asyncio.Event, interval: float = 0.05):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag.append(max(0.0, time.perf_counter() - started - interval))
+
+
+class Profiler:
+    # Nothing is running until profile() is called, one profiling window at a time
+    def __init__(self, interval: float = 0.005, max_seconds: float = 300, top_allocations: int = 25):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.top_allocations = top_allocations
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.lock.locked()
+
+    async def profile(self, seconds: float) -> ProfileReport:
+        seconds = min(max(seconds, 1), self.max_seconds)
+        async with self.lock:
+            sampler = SamplingProfiler(threading.get_ident(), self.interval)
+            lag = []
+            stop_lag = asyncio.Event()
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start(10)
+
+            sampler.start()
+            lag_task = asyncio.create_task(_measure_lag(lag, stop_lag))
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop_lag.set()
+                await lag_task
+                sampler.stop()
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracemalloc:
+                    tracemalloc.stop()
+
+            snapshot = snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ])
+            allocations = [str(stat) for stat in snapshot.statistics('lineno')[:self.top_allocations]]
+            return ProfileReport(seconds, sampler.samples, sampler.collapsed(), allocations, lag)
@@ -1,4 +1,6 @@
 import asyncio
+import os
+import time
 from datetime import datetime
 from enum import Enum
 from typing import Dict, List, Optional, BinaryIO
@@ -7,14 +9,23 @@ import httpx
 from httpx import AsyncClient
 from pydantic import Field
 
+from circuit_breaker import BreakerTransport, ServiceUnavailable, raindrop_breaker
 from db import BaseModel
-from utils import get_logger
+from utils import get_logger, json_loads
 
-ROOT_URL = 'https://api.raindrop.io/rest'
+ROOT_URL = os.getenv('RAINDROP_API_URL', 'https://api.raindrop.io/rest')
 
 logger = get_logger('bot')
 
 
+def rate_limit_delay(response: httpx.Response, default: float = 5) -> float:
+    # Raindrop reports when rate limit window resets as unix timestamp
+    reset = response.headers.get('X-RateLimit-Reset')
+    if reset and reset.isdigit():
+        return min(max(int(reset) - time.time(), 1), 60)
+    return default
+
+
 class RaindropApi:
     @staticmethod
     async def check_token(token: str) -> bool:
@@ -32,7 +43,8 @@ class RaindropApi:
 
     @property
     def client(self):
-        return httpx.AsyncClient(base_url=ROOT_URL, headers={'Authorization': f'Bearer {self.api_key}'})
+        return httpx.AsyncClient(base_url=ROOT_URL, headers={'Authorization': f'Bearer {self.api_key}'},
+                                 timeout=raindrop_breaker.call_timeout, transport=BreakerTransport(raindrop_breaker))
 
     async def post_link(self, link: str):
         await asyncio.sleep(3)
@@ -65,6 +77,13 @@ class SortOrder(str, Enum):
 
 class Collection(BaseResourceModel):
     id: int = Field(..., alias='_id')
+    title: str = Field('')
+    count: int = Field(0)
+    parent: Optional[Dict[str, int]] = Field(None)
+
+    @property
+    def parent_id(self) -> Optional[int]:
+        return self.parent.get('$id') if self.parent else None
 
 
 class RaindropUser(BaseResourceModel):
@@ -106,6 +125,34 @@ class Raindrop(BaseResourceModel):
         return result
 
 
+class RaindropLite:
+    # Compact version of Raindrop for hot paths (e.g. inline search). It's filled straight from API response and
+    # holds only fields we actually read, full model is validated only when requested
+    __slots__ = ('id', 'title', 'description', 'link', 'cover', 'raw')
+
+    def __init__(self, raw: dict):
+        self.id = raw['_id']
+        self.title = raw.get('title', '')
+        self.description = raw.get('excerpt') or ''
+        self.link = raw.get('link', '')
+        self.cover = raw.get('cover') or None
+        self.raw = raw
+
+    def validate(self, api: 'RaindropApi') -> Raindrop:
+        return Raindrop(api=api, **self.raw)
+
+    def to_pretty(self, mode: str = 'text') -> str:
+        if mode == 'markdown':
+            result = f'**[{self.title}]({self.link})**\n\n' \
+                     f'{self.description}'
+        else:
+            result = f'{self.title}\n' \
+                     f'{self.link}\n\n' \
+                     f'{self.description}'
+
+        return result
+
+
 class _ResourcesBase:
     def __init__(self, api):
         self.api = api
@@ -114,31 +161,44 @@ class _ResourcesBase:
 class _Raindrops(_ResourcesBase):
     async def get(self, *, collection_id: int = SpecialCollectionIds.all,
                   search: str = '', sort: SortOrder = SortOrder.sort_desc, page: int = 0,
-                  per_page: int = 50) -> List[Raindrop]:
+                  per_page: int = 50, retries: int = 0) -> List[RaindropLite]:
         async with self.api.client as client:
-            response = await client.get(f'/v1/raindrops/{collection_id}', params={
-                'search': search,
-                'sort': sort,
-                'page': page,
-                'perpage': per_page,
-            })
-            js = response.json()
-
-            return [Raindrop(api=self.api, **drop) for drop in js['items']]
-
+            for attempt in range(retries + 1):
+                response = await client.get(f'/v1/raindrops/{collection_id}', params={
+                    'search': search,
+                    'sort': sort,
+                    'page': page,
+                    'perpage': per_page,
+                })
+                if response.status_code == 429 and attempt < retries:
+                    delay = rate_limit_delay(response)
+                    logger.warning(f'Raindrop rate limit hit, retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+                    continue
+                break
+            if response.status_code >= 500:
+                raise ServiceUnavailable(raindrop_breaker.name)
+            js = json_loads(response.content)
+
+            return [RaindropLite(drop) for drop in js['items']]
 
     async def create(self, link: str, *, please_parse: bool = True,
-                     title: Optional[str] = None, description: Optional[str] = None) -> Optional[Raindrop]:
+                     title: Optional[str] = None, description: Optional[str] = None,
+                     collection_id: Optional[int] = None) -> Optional[Raindrop]:
         async with self.api.client as client:
             payload = {
                 'link': link
             }
+            if collection_id is not None:
+                payload['collection'] = {'$id': collection_id}
             if please_parse:
                 payload['pleaseParse'] = {}
             else:
                 payload['title'] = title
                 payload['excerpt'] = description
             response = await client.post(f'/v1/raindrop', json=payload)
+            if response.status_code >= 500:
+                raise ServiceUnavailable(raindrop_breaker.name)
             try:
                 response.raise_for_status()
                 js = response.json()
@@ -149,11 +209,78 @@ class _Raindrops(_ResourcesBase):
                 logger.exception('Error while creating raindrop')
                 return None
 
+    async def create_many(self, links: List[str], *, please_parse: bool = True, collection_id: Optional[int] = None,
+                          retries: int = 3) -> int:
+        # Raindrop accepts up to 100 items per request. Returns number of created raindrops
+        items = [{'link': link, 'pleaseParse': {}} if please_parse else {'link': link} for link in links]
+        if collection_id is not None:
+            for item in items:
+                item['collection'] = {'$id': collection_id}
+        async with self.api.client as client:
+            for attempt in range(retries + 1):
+                response = await client.post('/v1/raindrops', json={'items': items})
+                if response.status_code == 429 and attempt < retries:
+                    delay = rate_limit_delay(response)
+                    logger.warning(f'Raindrop rate limit hit, retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+                    continue
+                if response.status_code >= 500:
+                    raise ServiceUnavailable(raindrop_breaker.name)
+                try:
+                    response.raise_for_status()
+                    js = json_loads(response.content)
+                    return len(js['items']) if js['result'] else 0
+                except Exception as e:
+                    logger.exception('Error while creating raindrops')
+                    return 0
+        return 0
+
+    async def find_existing(self, link: str) -> Optional[int]:
+        # Returns id of user's raindrop with this link, if there is one
+        async with self.api.client as client:
+            response = await client.post('/v1/import/url/exists', json={'urls': [link]})
+            response.raise_for_status()
+            js = json_loads(response.content)
+            if js.get('result') and js.get('ids'):
+                return js['ids'][0]
+            return None
+
+    async def move(self, raindrop_id: int, collection_id: int) -> bool:
+        async with self.api.client as client:
+            response = await client.put(f'/v1/raindrop/{raindrop_id}', json={'collection': {'$id': collection_id}})
+            try:
+                response.raise_for_status()
+                return json_loads(response.content)['result']
+            except Exception as e:
+                logger.exception('Error while moving raindrop')
+                return False
+
+    async def update_link(self, raindrop_id: int, link: str, retries: int = 3) -> bool:
+        # Raindrop's bulk update (PUT /raindrops/{collectionId}) can't change links, so it's done one by one
+        async with self.api.client as client:
+            for attempt in range(retries + 1):
+                response = await client.put(f'/v1/raindrop/{raindrop_id}', json={'link': link})
+                if response.status_code == 429 and attempt < retries:
+                    delay = rate_limit_delay(response)
+                    logger.warning(f'Raindrop rate limit hit, retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+                    continue
+                try:
+                    response.raise_for_status()
+                    return json_loads(response.content)['result']
+                except Exception as e:
+                    logger.exception('Error while updating raindrop link')
+                    return False
+        return False
+
     async def upload_file(self, raindrop_id: int, file: BinaryIO, name: str, mime: str) -> bool:
+        # Raises ServiceUnavailable if Raindrop is down, so the upload can be retried later
         async with self.api.client as client:
             response = await client.put(f'/v1/raindrop/{raindrop_id}/file', files={
                 'file': (name, file, mime)
             })
+            if response.status_code >= 500:
+                raise ServiceUnavailable(raindrop_breaker.name)
             try:
                 response.raise_for_status()
                 return True
@@ -161,7 +288,32 @@ class _Raindrops(_ResourcesBase):
                 print(e)
                 return False
 
+    async def delete(self, raindrop_id: int) -> bool:
+        # Moves raindrop to Trash
+        async with self.api.client as client:
+            response = await client.delete(f'/v1/raindrop/{raindrop_id}')
+            try:
+                response.raise_for_status()
+                return json_loads(response.content)['result']
+            except Exception as e:
+                logger.exception('Error while deleting raindrop')
+                return False
+
 
-class _Collections:
-    def __init__(self, api_key):
-        self.api_key = api_key
\ No newline at end of file
+class _Collections(_ResourcesBase):
+    async def get_root(self) -> List[Collection]:
+        return await self._get('/v1/collections')
+
+    async def get_children(self) -> List[Collection]:
+        return await self._get('/v1/collections/childrens')
+
+    async def get_all(self) -> List[Collection]:
+        root, children = await asyncio.gather(self.get_root(), self.get_children())
+        return root + children
+
+    async def _get(self, path: str) -> List[Collection]:
+        async with self.api.client as client:
+            response = await client.get(path)
+            response.raise_for_status()
+            js = json_loads(response.content)
+            return [Collection(api=self.api, **item) for item in js['items']]
@@ -0,0 +1,164 @@
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from raindrop_api import RaindropApi
+from utils import get_logger
+
+logger = get_logger('bot')
+
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'yclid', 'mc_cid', 'mc_eid', 'ref_src')
+
+
+def normalize_url(url: str) -> str:
+    # Same page shared from different places usually differs only in case of host, tracking params and fragment
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f'{host}:{parts.port}'
+    query = sorted((key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if not key.lower().startswith(TRACKING_PARAMS))
+    path = parts.path.rstrip('/')
+    # http and https versions are treated as the same page
+    return urlunsplit(('', host, path, urlencode(query), ''))[2:]
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        # Optimal size and number of hashes for given capacity and false positive rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class RecentLinks:
+    # Remembers links users saved recently, so the same link sent again is answered without slow create call.
+    # Exact per-user LRU answers most repeats, optional Bloom filter remembers much more links in little memory,
+    # but as it has false positives its hits are only used to decide whether to ask Raindrop if the link exists
+    def __init__(self, max_users: int = 10000, per_user: int = 200, ttl: float = 7 * 24 * 60 * 60,
+                 bloom_capacity: int = 0, check_raindrop: bool = False):
+        self.max_users = max_users
+        self.per_user = per_user
+        self.ttl = ttl
+        self.check_raindrop = check_raindrop
+        self.users = OrderedDict()  # type: OrderedDict[int, OrderedDict[str, Tuple[float, int]]]
+        self.bloom_capacity = bloom_capacity
+        # Two generations: when current filter is full it becomes previous one, so old links are forgotten gradually
+        self.bloom = BloomFilter(bloom_capacity) if bloom_capacity else None
+        self.previous_bloom = None  # type: Optional[BloomFilter]
+        self.hits = 0
+        self.raindrop_checks = 0
+        self.raindrop_hits = 0
+
+    @classmethod
+    def from_env(cls) -> 'RecentLinks':
+        return cls(
+            per_user=int(os.getenv('RECENT_LINKS_PER_USER', 200)),
+            bloom_capacity=int(os.getenv('RECENT_LINKS_BLOOM_CAPACITY', 0)),
+            check_raindrop=os.getenv('CHECK_DUPLICATES_IN_RAINDROP', 'false') == 'true',
+        )
+
+    def _bloom_contains(self, key: str) -> bool:
+        return self.bloom is not None and (key in self.bloom or
+                                           (self.previous_bloom is not None and key in self.previous_bloom))
+
+    def _bloom_add(self, key: str):
+        if self.bloom is None:
+            return
+        if self.bloom.count >= self.bloom_capacity:
+            self.previous_bloom = self.bloom
+            self.bloom = BloomFilter(self.bloom_capacity)
+        self.bloom.add(key)
+
+    def get(self, user_id: int, link: str) -> Optional[int]:
+        links = self.users.get(user_id)
+        if links is None:
+            return None
+        key = normalize_url(link)
+        entry = links.get(key)
+        if entry is None:
+            return None
+        saved_at, raindrop_id = entry
+        if time.monotonic() - saved_at > self.ttl:
+            del links[key]
+            return None
+        links.move_to_end(key)
+        return raindrop_id
+
+    def remember(self, user_id: int, link: str, raindrop_id: int):
+        key = normalize_url(link)
+        links = self.users.get(user_id)  # type: Optional[OrderedDict[str, Tuple[float, int]]]
+        if links is None:
+            links = self.users[user_id] = OrderedDict()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        self.users.move_to_end(user_id)
+        links[key] = (time.monotonic(), raindrop_id)
+        links.move_to_end(key)
+        while len(links) > self.per_user:
+            links.popitem(last=False)
+        self._bloom_add(f'{user_id}:{key}')
+
+    def forget_user(self, user_id: int):
+        # Bloom filter can't forget, but its hits are verified with Raindrop anyway
+        self.users.pop(user_id, None)
+
+    async def find(self, user_id: int, link: str, api: RaindropApi) -> Optional[int]:
+        # Returns id of raindrop with this link if we know user already saved it
+        raindrop_id = self.get(user_id, link)
+        if raindrop_id is not None:
+            self.hits += 1
+            return raindrop_id
+
+        if not self.check_raindrop:
+            return None
+        if self.bloom is not None and not self._bloom_contains(f'{user_id}:{normalize_url(link)}'):
+            # Definitely wasn't saved through bot recently, no need to ask Raindrop
+            return None
+
+        self.raindrop_checks += 1
+        try:
+            raindrop_id = await api.raindrops.find_existing(link)
+        except Exception:
+            logger.exception('Error while checking if link was already saved')
+            return None
+        if raindrop_id is not None:
+            self.raindrop_hits += 1
+            self.remember(user_id, link, raindrop_id)
+        return raindrop_id
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'users': len(self.users),
+            'hits': self.hits,
+            'raindrop_checks': self.raindrop_checks,
+            'raindrop_hits': self.raindrop_hits,
+        }
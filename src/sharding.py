@@ -0,0 +1,186 @@
+import asyncio
+import queue as queue_module
+import multiprocessing
+import os
+import time
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher, types as tgtypes
+from aiogram.bot import api
+from aiogram.bot.api import TelegramAPIServer
+
+from backlog import BacklogDrainer
+from utils import get_logger
+
+logger = get_logger('bot')
+
+POLLING_TIMEOUT = 20
+SHARD_STATS_INTERVAL = 60
+# Multiprocessing queues are unbounded, but we don't want to buffer updates infinitely if workers are stuck
+MAX_SHARD_QUEUE_SIZE = 10000
+
+
+def update_user_id(update: dict) -> Optional[int]:
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('chat') or (value.get('message') or {}).get('chat')
+        if sender is not None:
+            return sender['id']
+    return None
+
+
+def shard_for(update: dict, shards: int) -> int:
+    # All updates of the same user must go to the same worker: it keeps their order and forwarded messages from
+    # one user can be stacked by StackForwardedMessagesMiddleware
+    user_id = update_user_id(update)
+    return hash(user_id) % shards if user_id is not None else 0
+
+
+def run_shard_worker(shard_id: int, updates: multiprocessing.Queue, processed):
+    # Entry point of worker process, runs ordinary RaindropioBot, but takes updates from supervisor instead of polling
+    from main import RaindropioBot
+
+    async def process(bot: 'RaindropioBot', raw_update: dict):
+        try:
+            await bot.dispatcher.process_update(tgtypes.Update(**raw_update))
+        except Exception:
+            logger.exception(f'Error while processing update in shard {shard_id}')
+        finally:
+            with processed.get_lock():
+                processed.value += 1
+
+    async def consume(bot: 'RaindropioBot'):
+        await bot.setup()
+        Bot.set_current(bot.bot)
+        Dispatcher.set_current(bot.dispatcher)
+        loop = asyncio.get_running_loop()
+        logger.info(f'Shard {shard_id} started in process {os.getpid()}')
+        # Event loop keeps only weak references to tasks
+        tasks = set()
+        while True:
+            raw_update = await loop.run_in_executor(None, updates.get)
+            if raw_update is None:
+                break
+            # Same as polling, every update gets its own task, they are started in order of arrival
+            task = asyncio.create_task(process(bot, raw_update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # Let updates which are already taken finish before worker exits
+        await asyncio.gather(*tasks)
+
+    loop = asyncio.get_event_loop()
+    bot = RaindropioBot(loop)
+    try:
+        loop.run_until_complete(consume(bot))
+    finally:
+        bot.shutdown()
+
+
+class ShardSupervisor:
+    # Receives updates once and routes them to N worker processes by user id. Dead workers are restarted
+    def __init__(self, shards: int):
+        bot_token = os.getenv('BOT_TOKEN', None)
+        if bot_token is None:
+            raise ValueError("You forgot to set BOT_TOKEN variable")
+        bot_server = TelegramAPIServer.from_base(os.getenv('BOT_SERVER_URL', 'https://api.telegram.org'))
+
+        self.bot = Bot(token=bot_token, server=bot_server)
+        self.shards = shards
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(MAX_SHARD_QUEUE_SIZE) for _ in range(shards)]
+        self.sent = [0] * shards
+        self.processed = [self.context.Value('q', 0) for _ in range(shards)]
+        self.processes = [None] * shards  # type: List[Optional[multiprocessing.Process]]
+        self.restarts = [0] * shards
+
+    def start_worker(self, shard_id: int):
+        process = self.context.Process(target=run_shard_worker, name=f'raindrop-shard-{shard_id}',
+                                       args=(shard_id, self.queues[shard_id], self.processed[shard_id]), daemon=True)
+        process.start()
+        self.processes[shard_id] = process
+
+    def check_workers(self):
+        for shard_id, process in enumerate(self.processes):
+            if process is None or not process.is_alive():
+                if process is not None:
+                    self.restarts[shard_id] += 1
+                    lost = self.queue_depth(shard_id)
+                    logger.error(f'Shard {shard_id} died with code {process.exitcode}, restarting. '
+                                 f'Up to {lost} in-flight updates might be lost')
+                    # Updates which worker took, but didn't finish, won't be processed anymore
+                    self.sent[shard_id] = self.processed[shard_id].value + self.queue_size(shard_id)
+                self.start_worker(shard_id)
+
+    def queue_size(self, shard_id: int) -> int:
+        try:
+            return self.queues[shard_id].qsize()
+        except NotImplementedError:
+            return 0
+
+    def queue_depth(self, shard_id: int) -> int:
+        # Both queued and currently processed updates
+        return self.sent[shard_id] - self.processed[shard_id].value
+
+    def shard_stats(self) -> List[dict]:
+        return [{
+            'shard': shard_id,
+            'pid': process.pid if process is not None else None,
+            'queued': self.queue_size(shard_id),
+            'depth': self.queue_depth(shard_id),
+            'processed': self.processed[shard_id].value,
+            'restarts': self.restarts[shard_id],
+        } for shard_id, process in enumerate(self.processes)]
+
+    async def dispatch(self, raw_update: dict):
+        shard_id = shard_for(raw_update, self.shards)
+        queue = self.queues[shard_id]
+        while True:
+            try:
+                queue.put_nowait(raw_update)
+                break
+            except queue_module.Full:
+                # Worker is overloaded, wait instead of blocking event loop
+                logger.warning(f'Shard {shard_id} queue is full')
+                await asyncio.sleep(0.1)
+        self.sent[shard_id] += 1
+
+    async def monitor(self):
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self.check_workers()
+            if time.monotonic() - last_report > SHARD_STATS_INTERVAL:
+                last_report = time.monotonic()
+                logger.info(f'Shards: {self.shard_stats()}')
+
+    async def poll(self, offset: Optional[int] = None):
+        while True:
+            try:
+                # Raw request, supervisor doesn't need to parse updates into objects. Raw params are sent as strings,
+                # so missing offset must be left out instead of becoming 'None'
+                payload = {'timeout': POLLING_TIMEOUT}
+                if offset is not None:
+                    payload['offset'] = offset
+                updates = await self.bot.request(api.Methods.GET_UPDATES, payload)
+            except Exception:
+                logger.exception('Error while getting updates')
+                await asyncio.sleep(1)
+                continue
+
+            for raw_update in updates:
+                await self.dispatch(raw_update)
+                offset = raw_update['update_id'] + 1
+
+    async def start(self):
+        logger.info(f'Starting supervisor with {self.shards} shards')
+        self.check_workers()
+        # Workers spread backlog over shards, but total rate is still limited by the drainer
+        offset = await BacklogDrainer.from_env(self.bot, self.dispatch).drain()
+        monitor = asyncio.create_task(self.monitor())
+        try:
+            await self.poll(offset)
+        finally:
+            monitor.cancel()
+            for queue in self.queues:
+                queue.put(None)
@@ -1,14 +1,26 @@
 import asyncio
+import atexit
 import functools
+import itertools
+import json
 import logging
 import os
+import queue
 import random
 import re
 import threading
+import time
+from collections import OrderedDict
 from contextvars import ContextVar
-from typing import Optional, Callable, Tuple
+from typing import Optional, Callable, Tuple, Union, List, Dict, Awaitable
+from logging.handlers import QueueHandler, QueueListener
 from aiogram import types as tgtypes
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 LOG_FORMAT_ASYNC = '[%(asctime)s][%(levelname)s][%(name)s][CTX %(async_context)s] %(message)s'
 LOG_FORMAT_SYNC = '[%(asctime)s][%(levelname)s][%(name)s][PID %(process)d][CTX %(threadName)s] %(message)s'
 
@@ -28,9 +40,62 @@ class AsyncAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# Format and write logs in background thread, so event loop only puts records into queue
+LOG_QUEUE = os.getenv('LOG_QUEUE', 'false') == 'true'
+# Fraction of records below WARNING to keep for noisy loggers, e.g. "bot.updates=0.01,bot.inline=0.1"
+LOG_SAMPLING = {
+    name.strip(): float(rate)
+    for name, rate in (item.split('=') for item in os.getenv('LOG_SAMPLING', '').split(',') if '=' in item)
+}
+
+_log_listeners = []  # type: List[QueueListener]
+
+
+class DeferredQueueHandler(QueueHandler):
+    # Default QueueHandler formats message in calling thread, here it's left to the listener thread. So log arguments
+    # must not be mutated right after logging call
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps every n-th record below WARNING, warnings and errors always pass
+    def __init__(self, rate: float):
+        super().__init__()
+        self.every = max(1, round(1 / rate)) if rate > 0 else 0
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        return self.every > 0 and next(self.counter) % self.every == 0
+
+
+def _stop_log_listeners():
+    for listener in _log_listeners:
+        listener.stop()
+
+
+def _make_log_handler(formatter: logging.Formatter) -> logging.Handler:
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.DEBUG)
+    stream_handler.setFormatter(formatter)
+    if not LOG_QUEUE:
+        return stream_handler
+
+    if not _log_listeners:
+        atexit.register(_stop_log_listeners)
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, stream_handler, respect_handler_level=True)
+    listener.start()
+    _log_listeners.append(listener)
+    return DeferredQueueHandler(records)
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL)
 
     try:
         asyncio.get_running_loop()
@@ -38,17 +103,27 @@ def get_logger(name):
     except RuntimeError:
         async_context = False
 
+    if '.' in name:
+        # Child loggers like 'bot.updates' write through handler of their parent
+        get_logger(name.split('.')[0])
+
     if not logger.hasHandlers():
         formatter = logging.Formatter(LOG_FORMAT_ASYNC if async_context else LOG_FORMAT_SYNC)
+        logger.addHandler(_make_log_handler(formatter))
 
-        ch = logging.StreamHandler()
-        ch.setLevel(logging.DEBUG)
-        ch.setFormatter(formatter)
-        logger.addHandler(ch)
+    if name in LOG_SAMPLING and not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(LOG_SAMPLING[name]))
 
     return AsyncAdapter(logger, {'async_context': 'global'}, async_context)
 
 
+def json_loads(data: Union[bytes, str]):
+    # orjson is noticeably faster on big API responses, but it's optional
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 def generate_random_id(count=10):
     return ''.join(random.choices(['1', '2', '3', '4', '5', '6', '7', '8', '9', '0',
                                    'a', 'b', 'c', 'd', 'e', 'f'], k=count))
@@ -73,10 +148,11 @@ def set_logger_context_on_enter(logger: Optional[AsyncAdapter] = None, enter_exi
     return wrapper
 
 
-async def generate_post_pretty_html(message: tgtypes.Message, include_forward_from: bool = True):
+async def generate_post_pretty_html(message: tgtypes.Message, include_forward_from: bool = True,
+                                    forward_source: Optional[Tuple[str, str]] = None):
     text = ''
     if include_forward_from and message.is_forward():
-        forward_from, url = await extract_forward_source(message)
+        forward_from, url = forward_source or await extract_forward_source(message)
         if url:
             link = f'<a href="{url}" target="_blank" class="forward-source">{forward_from}</a>'
         else:
@@ -94,6 +170,25 @@ async def generate_post_pretty_html(message: tgtypes.Message, include_forward_fr
     return text
 
 
+def drops_to_inline_results(drops) -> List[tgtypes.InlineQueryResultArticle]:
+    results = []
+    for drop in drops:
+        input_content = tgtypes.InputTextMessageContent(drop.to_pretty('markdown'), parse_mode='markdown')
+        results.append(tgtypes.InlineQueryResultArticle(id=drop.id, title=drop.title, description=drop.description,
+                                                        url=drop.link, input_message_content=input_content,
+                                                        thumb_url=drop.cover))
+    return results
+
+
+def html_hits_to_inline_results(hits) -> List[tgtypes.InlineQueryResultArticle]:
+    results = []
+    for hit in hits:
+        input_content = tgtypes.InputTextMessageContent(f'**[{hit.title}]({hit.link})**', parse_mode='markdown')
+        results.append(tgtypes.InlineQueryResultArticle(id=hit.id, title=hit.title, description=hit.snippet,
+                                                        url=hit.link, input_message_content=input_content))
+    return results
+
+
 def guess_title(text: str) -> str:
     if not text:
         return ''
@@ -109,7 +204,53 @@ def guess_title(text: str) -> str:
     return text[:60]  # optimal len
 
 
-async def extract_forward_source(message: tgtypes.Message, ) -> Tuple[str, str]:
+class ForwardSourceCache:
+    # Resolving link of private channel takes getChat request, and stacks usually have many messages from the same
+    # one. Resolved sources are kept for a while, concurrent lookups of the same source share one request
+    def __init__(self, max_size: int = 2048, ttl: float = 60 * 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # type: OrderedDict[Tuple[str, int], Tuple[float, Tuple[str, str]]]
+        self.pending = {}  # type: Dict[Tuple[str, int], asyncio.Future]
+
+    async def get(self, key: Tuple[str, int], resolve: Callable[[], Awaitable[Tuple[str, str]]]) -> Tuple[str, str]:
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() < entry[0]:
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        future = asyncio.ensure_future(resolve())
+        self.pending[key] = future
+        try:
+            source = await asyncio.shield(future)
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        self.entries[key] = (time.monotonic() + self.ttl, source)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return source
+
+
+forward_sources = ForwardSourceCache(ttl=float(os.getenv('FORWARD_SOURCE_CACHE_TTL', 60 * 60)))
+
+
+def forward_source_key(message: tgtypes.Message) -> Optional[Tuple[str, int]]:
+    # Hidden senders have nothing to resolve, they are identified only by name
+    if message.forward_sender_name is not None:
+        return None
+    if message.forward_from is not None:
+        return 'user', message.forward_from.id
+    if message.forward_from_chat is not None:
+        return 'chat', message.forward_from_chat.id
+    return None
+
+
+async def _resolve_forward_source(message: tgtypes.Message) -> Tuple[str, str]:
     if message.forward_sender_name is not None:
         text = message.forward_sender_name
     elif message.forward_from is not None:
@@ -132,6 +273,24 @@ async def extract_forward_source(message: tgtypes.Message, ) -> Tuple[str, str]:
     return text, link
 
 
+async def extract_forward_source(message: tgtypes.Message) -> Tuple[str, str]:
+    key = forward_source_key(message)
+    if key is None:
+        return await _resolve_forward_source(message)
+    return await forward_sources.get(key, functools.partial(_resolve_forward_source, message))
+
+
+async def extract_forward_sources(messages: List[tgtypes.Message]) -> List[Tuple[str, str]]:
+    # Resolves every distinct source of the stack once, all of them at the same time
+    first_messages = {}
+    for message in messages:
+        first_messages.setdefault(forward_source_key(message) or id(message), message)
+    keys = list(first_messages)
+    resolved = await asyncio.gather(*[extract_forward_source(first_messages[key]) for key in keys])
+    by_key = dict(zip(keys, resolved))
+    return [by_key[forward_source_key(message) or id(message)] for message in messages]
+
+
 
 
 